@@ -8,11 +8,16 @@
 import pandas as pd
 import geopandas as gpd
 import fiona
-import shutil,os
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import exifread
 import argparse
 import tomli
+import sys
+sys.path.append( str( Path(__file__).resolve().parent.joinpath('ObliqueCamera') ) )  # Copy_Lib, RigCheck_Lib
+from Copy_Lib import CopyPhotos, COPY_MODE
+from RigCheck_Lib import ValidateRig, PrintReport
 
 class ObliqueBlock:
     def __init__(self, ARGS, CONFIG ):
@@ -34,38 +39,67 @@ class ObliqueBlock:
             latlng.append( dms )
         return latlng
 
+    def _readEXIF( self, PathJPEG ):
+        ''' only Model and GPS lat/lng are needed, skip MakerNote and thumbnail.
+            stop_tag only ends parsing of the GPS IFD holding GPSLongitude,
+            IFD0, the thumbnail IFD and the Exif IFD are still walked '''
+        with open( PathJPEG, 'rb') as f:
+            tags = exifread.process_file( f, details=False, extract_thumbnail=False,
+                                          stop_tag='GPSLongitude' )
+        model = tags['Image Model'].values
+        lat,lng = self._getLL( tags )
+        return [model,lat,lng]
+
     def HarvestPhoto(self, DIR ):
-        FOLDER = self.CONFIG['model'][ARGS.model]['FOLDER']
-        RIGPOS = self.CONFIG['model'][ARGS.model]['RIGPOS']
+        FOLDER = self.CONFIG['model'][self.ARGS.model]['FOLDER']
+        RIGPOS = self.CONFIG['model'][self.ARGS.model]['RIGPOS']
         LUT = dict( zip( FOLDER, RIGPOS )  )
-        NDIGIT = self.CONFIG['model'][ARGS.model]['NDIGIT']
+        NDIGIT = self.CONFIG['model'][self.ARGS.model]['NDIGIT']
         jpegs = list( DIR.glob( '**/*.JPG' ) )
-        df = pd.DataFrame( jpegs, columns=['PathJPEG'] )
-        def MakePath( row, LUT, NDIGIT ):
-            STEM = row.PathJPEG.stem
-            f = open( row.PathJPEG, 'rb')
-            tags = exifread.process_file(f)
-            model = tags['Image Model'].values
-            lat,lng = self._getLL( tags )
-            rig_struct = self.CONFIG['model'][ARGS.model]
-            folder = row.PathJPEG.parents[0].stem
-            if folder not in rig_struct['FOLDER']:
-                raise Warning( f'{folder} not in rig structure ')
-            rigpos = LUT[ folder ]
-            rignum = row.PathJPEG.stem[-NDIGIT:]
-            pathjpeg = str( row.PathJPEG )
-            return [pathjpeg, STEM,model,rigpos,rignum, lat,lng]
-        df[['PathJPEG', 'STEM','model', 'RigPos', 'RigNum', 'lat','lng' ]] = df.apply( 
-                          MakePath, axis=1, result_type='expand',args=(LUT,NDIGIT) )
-        return df 
+        with ThreadPoolExecutor( max_workers=self.ARGS.jobs ) as pool:
+            stats = list( pool.map( os.stat, jpegs ) )
+        df = pd.DataFrame( { 'PathJPEG': [ str(p) for p in jpegs ],
+                             'size'    : [ st.st_size for st in stats ],
+                             'mtime_ns': [ st.st_mtime_ns for st in stats ] } )
+        #############################################
+        # EXIF sidecar index keyed by path/size/mtime, only new or changed
+        # photos are read again, photos of other folders are kept in the index
+        EXIF_IDX = self.CACHE.joinpath( 'ExifIndex.csv' )
+        EXIF_COL = ['model', 'lat', 'lng']
+        IDX_COL = ['PathJPEG','size','mtime_ns',*EXIF_COL]
+        if EXIF_IDX.exists():
+            dfIdx = pd.read_csv( EXIF_IDX, dtype={'model':str} )
+            df = pd.merge( df, dfIdx, how='left', on=['PathJPEG','size','mtime_ns'] )
+        else:
+            dfIdx = pd.DataFrame( columns=IDX_COL )
+            df[EXIF_COL] = None
+        todo = df.model.isna()
+        print( f'Harvesting EXIF of {todo.sum():,} new/changed photos, '\
+               f'{(~todo).sum():,} from "{EXIF_IDX}" ...' )
+        if todo.any():
+            with ThreadPoolExecutor( max_workers=self.ARGS.jobs ) as pool:
+                exif = list( pool.map( self._readEXIF, df.PathJPEG[todo] ) )
+            df.loc[todo, EXIF_COL] = pd.DataFrame( exif, columns=EXIF_COL, 
+                                                   index=df.index[todo] )
+            dfIdx = dfIdx[ ~dfIdx.PathJPEG.isin( df.PathJPEG ) ]
+            pd.concat( [ dfIdx, df[IDX_COL] ], ignore_index=True ).to_csv( EXIF_IDX, index=False )
+        df[['lat','lng']] = df[['lat','lng']].astype(float)
+        #############################################
+        PATH = df.PathJPEG.map( Path )
+        folder = PATH.map( lambda p: p.parents[0].stem )
+        if not folder.isin( FOLDER ).all():
+            raise Warning( f'{folder[~folder.isin(FOLDER)].unique()} not in rig structure ')
+        df['STEM'] = PATH.map( lambda p: p.stem )
+        df['RigPos'] = folder.map( LUT )
+        df['RigNum'] = df.STEM.str[-NDIGIT:]
+        return df[['PathJPEG', 'STEM','model', 'RigPos', 'RigNum', 'lat','lng' ]]
 
     def Step1_CheckPlot( self):
         print('1. Check rig integrity 5 photos per rig ...' )
         print( self.gdfPHO['RigPos'].value_counts() )
-        for rig,grp in self.gdfPHO.groupby(['RigNum']):
-            if len(grp) != 5:
-                print( f'***ERROR*** rig number "{rig}" has wrong rig postions...' )
-                print( grp )
+        RIGPOS = self.CONFIG['model'][self.ARGS.model]['RIGPOS']
+        self.RigReport = ValidateRig( self.gdfPHO, RIGPOS, RIG='RigNum', POS='RigPos' )
+        PrintReport( self.RigReport )
         BLK_PLT = self.CACHE.joinpath( 'ObliqueBlock.gpkg' ) 
         print( f'Plotting oblique block "{BLK_PLT}"...')
         self.gdfPHO.to_file( BLK_PLT , driver='GPKG')
@@ -84,18 +118,15 @@ class ObliqueBlock:
     
     def Step3_CopyPhoto(self, dfPHO ):
         print(f'3. Copy "{len(dfPHO)} photos" to CACHE/PHOTO_RIG/ ...')
-        for rigpos,grp in dfPHO.groupby(['RigPos']):
-            CACHE_RIG = self.CACHE.joinpath(f'./PHOTO_RIG/{rigpos}' )
-            CACHE_RIG.mkdir(parents=True, exist_ok=True)
-            for i,photo in grp.iterrows():
-                src = Path(photo.PathJPEG)
-                dst = CACHE_RIG.joinpath(  Path(photo.PathJPEG).name )
-                #import pdb; pdb.set_trace()
-                if self.ARGS.copy:
-                    print( f'Copying [{i:05d}]: {src} -> {dst}...' )
-                    shutil.copyfile( src, dst ) 
-                else:
-                    print( f'Planned! copying [{i:05d}]: {src} -> {dst}...' )
+        SRC = [ Path(p) for p in dfPHO.PathJPEG ]
+        DST = [ self.CACHE.joinpath( f'./PHOTO_RIG/{rigpos}/{src.name}' ) 
+                    for rigpos,src in zip( dfPHO.RigPos, SRC ) ]
+        if self.ARGS.copy:
+            CopyPhotos( SRC, DST, MODE=self.ARGS.mode, WORKERS=self.ARGS.jobs,
+                        MANIFEST=self.CACHE.joinpath( './PHOTO_RIG/CopyPhoto.manifest' ) )
+        else:
+            for i,(src,dst) in enumerate( zip( SRC,DST ) ):
+                print( f'Planned! copying [{i:05d}]: {src} -> {dst}...' )
 
 ##############################################################
 ##############################################################
@@ -117,6 +148,10 @@ parser.add_argument("-m", "--model", dest='model', required=True,
 parser.add_argument("-r", "--roi", dest='FILE_ROI', help="input ROI in geojason format",
                     type=argparse.FileType('r'))
 parser.add_argument("-c", "--copy", action='store_true', help="do copying files" )
+parser.add_argument("--mode", choices=COPY_MODE, default='copy',
+        help="copy files or hardlink/symlink them when on the same filesystem, default copy" )
+parser.add_argument("-j", "--jobs", type=int, default=16, 
+        help="number of threads reading photos, default 16" )
 
 ARGS = parser.parse_args()
 print( ARGS )
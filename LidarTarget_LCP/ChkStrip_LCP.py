@@ -1,15 +1,26 @@
 #
-# ChkLCP_strip.py : read all point-cloud (.las) from each overlapping
-#                   strips , creat convex hull around each strip then
-#                   intersects with LCP. The result of LCP presents in
-#                   any strip will be write down in YAML file.
+# ChkLCP_strip.py : read all point-cloud (.las/.laz) from each overlapping
+#                   strips , creat footprint polygon of each strip from
+#                   a streamed occupancy grid then intersects with LCP.
+#                   The result of LCP presents in any strip will be write
+#                   down in YAML file. Footprints are built in parallel and
+#                   cached in CACHE/LidarBlock.gpkg by LAS size/mtime.
+#                   Returns on both roof panels are counted by reading the
+#                   panel windows, LCP with a panel below MINPOINTS is skipped.
 #
-import laspy
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import MultiPoint
+import numpy as np
+import shapely
+import hashlib
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from Las_Lib import CountGrid, GridPolygon, ReadWindows
 import argparse
+import yaml
+
+FILE_GPKG = './CACHE/LidarBlock.gpkg'
+KEY_DTYPE = { 'infile':str, 'size':'int64', 'mtime_ns':'int64', 'cell':float, 'npnt':'int64' }
 
 YAML_HDR ='''VERSION : "0.3"
 # configuration and data file for lidar control plane
@@ -23,11 +34,45 @@ LENGTH : 1.220   # m  of the future board
 BUFF_RIDGE : 1.2   # %buffer from actual LCP size
 BUFF_LFRT  : [0.1,0.8]   # %buffer to the left&right of  LCP ridge line 
 #
-# Lidar sensor response via "pyransac3d"
+# Lidar sensor response via RANSAC (Ransac_Lib)
 MINPOINTS : 100
 THRESH    : 0.05   # meter
 MAXITER   : 1000
 '''
+HDR = yaml.safe_load( YAML_HDR )
+def StripKey( INFILE, CELL ):
+    ''' cache key of a strip footprint, infile,size,mtime_ns,cell '''
+    st = Path( INFILE ).stat()
+    return ( str(INFILE), st.st_size, st.st_mtime_ns, float(CELL) )
+
+def _KeyStr( KEY ):
+    return f'{Path(KEY[0]).resolve()}|{KEY[1]}|{KEY[2]}|{KEY[3]}'
+
+def GridFile( KEY ):
+    ''' count grid of a strip named by hash of its footprint cache key '''
+    h = hashlib.sha1( _KeyStr( KEY ).encode() ).hexdigest()[:16]
+    return f'./CACHE/GRID/{Path(KEY[0]).stem}_{h}.npz'
+
+def ReadGrid( KEY ):
+    ''' cached COUNT,GRID of strip KEY, None when missing or built for
+        another key '''
+    if not Path( GridFile( KEY ) ).exists(): return None
+    with np.load( GridFile( KEY ) ) as npz:
+        if npz['KEY'].item()!=_KeyStr( KEY ): return None
+        return npz['COUNT'], npz['GRID']
+
+def CreateHull( KEY ):
+    ''' stream the point cloud of strip KEY into a coarse count grid, constant
+        memory, the grid is kept in CACHE/GRID for the footprint cache '''
+    INFILE,CELL = KEY[0], KEY[3]
+    COUNT,GRID = CountGrid( INFILE, CELL )
+    Path( GridFile( KEY ) ).parent.mkdir( parents=True, exist_ok=True )
+    np.savez_compressed( GridFile( KEY ), COUNT=COUNT, GRID=GRID, 
+                         KEY=np.array( _KeyStr( KEY ) ) )
+    hull = GridPolygon( COUNT, GRID )
+    npnt = shapely.get_num_coordinates( hull )
+    return hull,npnt
+
 class LidarBlock:
     def __init__(self, WILD_LAS, args):
         self.WILD_LAS = WILD_LAS
@@ -37,6 +82,7 @@ class LidarBlock:
         dfStrip = self.CreateStrip( )
         self.dfStripLCP = gpd.sjoin( dfStrip, dfLCP, how='inner', predicate='intersects' )
         self.dfStripLCP.reset_index( drop=True, inplace=True )
+        self.CountLCP()
         self.dfStrip = dfStrip
         self.dfLCP = dfLCP
         nLCP,nLCP_Strip = len(dfLCP), len(pd.unique(self.dfStripLCP.NAME))
@@ -45,6 +91,40 @@ class LidarBlock:
         LCP_strip = self.dfStripLCP['NAME'].unique()
         self.dfLCP_strip = self.dfLCP[self.dfLCP.NAME.isin( LCP_strip ) ].copy()
 
+    def CountLCP( self ):
+        ''' real returns of each strip on the left and right roof panel windows
+            cut as EstimLCP does (BASE, LENGTH, BUFF_LFRT, BUFF_RIDGE rotated by
+            AZ), only pages of the windows are read via the LAS grid index.
+            Columns 'count_L', 'count_R', 'count' and 'density' (pnt/sqm), as
+            MINPOINTS applies to each panel plane, pairs with a panel below
+            MINPOINTS are 'skip' '''
+        BAS,LEN = HDR['BASE'], HDR['LENGTH']
+        BFLR, BFRD = HDR['BUFF_LFRT'], HDR['BUFF_RIDGE']
+        x0,x1 = (BAS/2)*BFLR[0], (BAS/2)*BFLR[1] ; y1 = BFRD*LEN/2
+        HALF = np.hypot( x1, y1 )       # window holding both panels at any AZ
+        df = self.dfStripLCP
+        df['count_L'] = 0 ; df['count_R'] = 0
+        for infile,idx in df.groupby('infile').groups.items():
+            X,Y = df.loc[idx,'Easting'].to_numpy(), df.loc[idx,'Northing'].to_numpy()
+            AZI = np.radians( df.loc[idx,'AZ'].to_numpy( float ) )
+            BBOXES = list( zip( X-HALF, Y-HALF, X+HALF, Y+HALF ) )
+            print( f'Counting returns of {len(idx)} LCPs in strip {infile} ...' )
+            for i,dfWin,x,y,azi in zip( idx, ReadWindows( infile, BBOXES ), X, Y, AZI ):
+                c,s = np.cos(azi), np.sin(azi)
+                dx = dfWin.x.to_numpy( float )-x ; dy = dfWin.y.to_numpy( float )-y
+                lx = c*dx - s*dy ; ly = s*dx + c*dy
+                ALONG = np.abs(ly)<=y1
+                df.at[i,'count_L'] = np.count_nonzero( ALONG&(lx>=-x1)&(lx<=-x0) )
+                df.at[i,'count_R'] = np.count_nonzero( ALONG&(lx>=x0)&(lx<=x1) )
+        df['count'] = df.count_L+df.count_R
+        df['density'] = df['count']/( 2*(x1-x0)*2*y1 )
+        df['skip'] = np.minimum( df.count_L, df.count_R )<HDR['MINPOINTS']
+        if df.skip.any():
+            print( f'***WARNING*** {df.skip.sum()} LCP-strip pairs with a roof panel of less '\
+                   f'than MINPOINTS={HDR["MINPOINTS"]} returns are skipped ...' )
+            print( df[df.skip][['strip','NAME','count_L','count_R','density']].to_string( 
+                             index=False, float_format='{:.1f}'.format ) )
+
     def CreateLCP( self ):
         FILE_LCP = '**/LCP_RTKh.csv','**/LCP_ORIENT.csv' 
         print( f'Prepare LCP from {FILE_LCP}... ' )
@@ -64,38 +144,66 @@ class LidarBlock:
                 geometry=gpd.points_from_xy( df.Easting, df.Northing ) )
         return df
 
-    def CreateHull(self, INFILE ):
-        # Open the point cloud file using laspy
-        with laspy.open(INFILE,mode='r') as inFile:
-            xyz = inFile.read().xyz
-            # Create a pandas dataframe from the coordinates
-            df = pd.DataFrame({'x': xyz[:,0], 'y': xyz[:,1], 'z': xyz[:,2] })
-            df = df.sample( n=int(len(df)/self.ARGS.reduce ) )  # n-times reduced
-        hull = MultiPoint(df[['x','y']].values).convex_hull
-        npnt = len(hull.exterior.coords)
-        return hull,npnt
-
     def CreateStrip(self):
-        data =list()
-        LAS = sorted( Path('.').glob( self.WILD_LAS) )
+        LAS = dict()      # one file per strip, .las preferred over .laz
+        for f in sorted( Path('.').glob( self.WILD_LAS) ):
+            key = f.with_suffix('')
+            if key not in LAS or f.suffix.lower()=='.las':
+                LAS[key] = f
+        LAS = list( LAS.values() )
         if len(LAS)==0: 
-            raise Warning(f'***ERROR*** no LAS from "{PATTERN}" ...')
-        LIMIT = self.ARGS.limit
+            raise Warning(f'***ERROR*** no LAS from "{self.WILD_LAS}" ...')
+        if self.ARGS.limit>0:
+            LAS = LAS[:self.ARGS.limit]
+        dfCache = self.ReadFootprint()
+        data = dict() ; todo = list()
         for INFILE in LAS:
-            hull,npnt = self.CreateHull( INFILE )
+            key = StripKey( INFILE, self.ARGS.cell )
+            if key in dfCache.index and ReadGrid( key ) is not None:
+                row = dfCache.loc[key]
+                print(f'Cached footprint of strip {INFILE} with {row.npnt} vertices')
+                data[INFILE] = [ *key, INFILE.stem, row.npnt, row.geometry ]
+            else:
+                todo.append( (INFILE,key) )
+        JOBS = min( self.ARGS.jobs, len(todo) )
+        if JOBS>1:
+            print(f'Creating footprints of {len(todo)} strips with {JOBS} processes ...')
+            with ProcessPoolExecutor( max_workers=JOBS ) as pool:
+                hulls = list( pool.map( CreateHull, [ k for _,k in todo ] ) )
+        else:
+            hulls = [ CreateHull( k ) for _,k in todo ]
+        for (INFILE,key),(hull,npnt) in zip( todo, hulls ):
             print('Creating hull from strip {} with {} vertices'.\
                     format(INFILE, npnt))
-            data.append( [str(INFILE),INFILE.stem,npnt,hull.buffer(self.ARGS.shrink) ] )
-            if LIMIT==1: 
-                break
-            else: 
-                LIMIT -= 1
-        df = pd.DataFrame( data , columns=['infile', 'strip', 'npnt', 'geometry'] )
+            data[INFILE] = [ *key, INFILE.stem, npnt, hull ]
+        COLS = [ 'infile', 'size', 'mtime_ns', 'cell', 'strip', 'npnt', 'geometry' ]
+        df = pd.DataFrame( [ data[f] for f in LAS ], columns=COLS ).astype( KEY_DTYPE )
         gdf = gpd.GeoDataFrame( df, crs='EPSG:32647', geometry=df.geometry )
-        return gdf
+        if len(todo):
+            self.WriteFootprint( gdf, dfCache )
+        gdf['geometry'] = gdf.buffer( self.ARGS.shrink )
+        return gdf[ ['infile', 'strip', 'npnt', 'geometry'] ]
+
+    def ReadFootprint(self):
+        ''' cached footprints (unbuffered) indexed by infile,size,mtime_ns,cell '''
+        KEY = [ 'infile', 'size', 'mtime_ns', 'cell' ]
+        if Path( FILE_GPKG ).exists() and \
+                'FOOTPRINT' in gpd.list_layers( FILE_GPKG ).name.values:
+            dfCache = gpd.read_file( FILE_GPKG, layer='FOOTPRINT' )
+        else:               # no cache yet
+            dfCache = gpd.GeoDataFrame( columns=KEY+['strip','npnt','geometry'] )
+        return dfCache.astype( KEY_DTYPE ).set_index( KEY )
+
+    def WriteFootprint(self, gdf, dfCache ):
+        ''' refresh FOOTPRINT layer, footprints of other strips are kept '''
+        dfCache = dfCache.reset_index()
+        dfCache = dfCache[ ~dfCache.infile.isin( gdf.infile ) ]
+        dfFP = pd.concat( [ dfCache, gdf ], ignore_index=True )
+        dfFP = gpd.GeoDataFrame( dfFP, crs='EPSG:32647', geometry='geometry' )
+        print(f'Caching {len(dfFP)} footprints in "{FILE_GPKG}" ...')
+        dfFP.to_file( FILE_GPKG, driver='GPKG', layer='FOOTPRINT' )
 
     def WriteBlock( self ):
-        FILE_GPKG = './CACHE/LidarBlock.gpkg'
         print(f'Writing "{FILE_GPKG}" ...')
         self.dfLCP.to_file( FILE_GPKG, driver='GPKG', layer='LCP' )
         self.dfLCP_strip.to_file( FILE_GPKG, driver='GPKG', layer='LCP_strip')
@@ -108,39 +216,52 @@ class LidarBlock:
         print(f'Writing "{FILE_YAML}"...')
         with open( FILE_YAML,'w') as f:
             f.write( YAML_HDR )
-            f.write('FLIGHT_LINE :\n')
+            if self.dfStripLCP.skip.all():
+                print( '***WARNING*** no strip has any LCP with MINPOINTS returns ...' )
+                f.write('FLIGHT_LINE : {}\n')
+            else:
+                f.write('FLIGHT_LINE :\n')
             for name,dflcp in self.dfStripLCP.groupby('strip'):
-                f.write( '{}{}:\n'.format( 4*' ', dflcp.iloc[0].infile ) )
+                if dflcp.skip.all(): 
+                    f.write( '#{}{}:   # no LCP with MINPOINTS returns\n'.format( 3*' ', 
+                                                            dflcp.iloc[0].infile ) )
+                else:
+                    f.write( '{}{}:\n'.format( 4*' ', dflcp.iloc[0].infile ) )
                 for idx,lcp in dflcp.iterrows():
-                    f.write( '{} - [ {},{},{},{},{} ]\n'.format( 8*' ', 
-                        lcp.NAME, lcp.Easting, lcp.Northing , lcp.HAE, lcp.AZ ) )
+                    f.write( '{}{} - [ {},{},{},{},{} ]   # {:.0f} pnt, {:.1f} pnt/sqm{}\n'.format( 
+                        '#' if lcp.skip else ' ', 7*' ',
+                        lcp.NAME, lcp.Easting, lcp.Northing , lcp.HAE, lcp.AZ,
+                        lcp['count'], lcp.density, ', skipped' if lcp.skip else '' ) )
 
 #######################################################################
 #######################################################################
 #######################################################################
-parser = argparse.ArgumentParser(description=
-''' Read lidar by flight-strip and analyze if any LCP falls on any
-    flight-strip, then write the result in YAML for processing in 
-    further step with EstimLCP.py. (P.Santitamnont,Chula.Unive Feb,2023''')
-parser.add_argument('-r', '--reduce', dest='reduce', default=1000, type=int,
-    help='reduce number of point-cloud, default 1000-times, suggest 10/100/1000/10000')
-parser.add_argument('-s', '--shrink', dest='shrink', default=-5, type=int,
-    help='shrink polygon hulling point-cloud by default -5 meter')
-parser.add_argument('-y', '--yaml', dest='yaml', action='store_true',
-    help='generate YAML file for later used by EstimLCP.py... ')
-parser.add_argument('-l', '--limit', dest='limit', default=-1, type=int, 
-    help='limit only first n-files !!! FOR DEBUG !!!')
-
-args = parser.parse_args()
-print( args )
-
-FILE_LAS = './AA450/LasFile/AA450-*.las'
-
-lb = LidarBlock( FILE_LAS, args )
-lb.WriteBlock()
-if args.yaml :
-    lb.WriteYAML()
-
-print('******* end of ChkLCP_strip.py ********')
-#import pdb ; pdb.set_trace()
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description=
+    ''' Read lidar by flight-strip and analyze if any LCP falls on any
+        flight-strip, then write the result in YAML for processing in 
+        further step with EstimLCP.py. (P.Santitamnont,Chula.Unive Feb,2023''')
+    parser.add_argument('-c', '--cell', dest='cell', default=2.0, type=float,
+        help='cell size of occupancy grid for strip footprint, default 2 meter')
+    parser.add_argument('-s', '--shrink', dest='shrink', default=-5, type=int,
+        help='shrink polygon hulling point-cloud by default -5 meter')
+    parser.add_argument('-j', '--jobs', dest='jobs', default=1, type=int,
+        help='number of processes building strip footprints, default 1')
+    parser.add_argument('-y', '--yaml', dest='yaml', action='store_true',
+        help='generate YAML file for later used by EstimLCP.py... ')
+    parser.add_argument('-l', '--limit', dest='limit', default=-1, type=int, 
+        help='limit only first n-files !!! FOR DEBUG !!!')
+
+    args = parser.parse_args()
+    print( args )
+
+    FILE_LAS = './AA450/LasFile/AA450-*.la[sz]'
+
+    lb = LidarBlock( FILE_LAS, args )
+    lb.WriteBlock()
+    if args.yaml :
+        lb.WriteYAML()
+
+    print('******* end of ChkLCP_strip.py ********')
+    #import pdb ; pdb.set_trace()
 
@@ -14,19 +14,71 @@ import pandas as pd
 import geopandas as gpd
 import numpy as np 
 import skspatial.objects as sko
-import shapely.geometry as shpgeom
-import shapely.affinity as affinity
 import yaml
 import matplotlib.pyplot as plt
-import laspy 
-import pyransac3d as pyrsc
+from Las_Lib import ReadWindows
+from Ransac_Lib import PlaneRANSAC
 import argparse
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+import pickle
 from pathlib import Path 
-plt.switch_backend('TkAgg')
 
 #############################################################################
+def _InitWorker():
+    plt.switch_backend('Agg')    # --jobs and render workers only write files
+
+PLOT_POLICY = [ 'inline', 'off', 'deferred', 'background' ]
+PLOT_MAX = 20_000    # points drawn per plot, decimated beyond
+
 XYZ = ['x','y','z'] 
 COL_DXYZ = [ 'Name','x','y','z', 'dx', 'dy', 'dh', 'FlighLine']
+
+def PlotRoof( PntXYZ, dfPnt, RIDGE=None, TITLE=None, PLOT_FILE=None, 
+              MAX_PNT=PLOT_MAX, RASTER=False ):
+    ''' 3D scatter of target/roof points, plt.show() if PLOT_FILE is None.
+        Point cloud larger than MAX_PNT is decimated, RASTER rasterizes the
+        scatters of a vector SVG/PDF output '''
+    Z_ASPECT = 0.5
+    if MAX_PNT is not None and len(dfPnt)>MAX_PNT:
+        dfPnt = dfPnt.sample( MAX_PNT, random_state=0 )
+    cm = plt.cm.get_cmap('RdYlBu_r')  # color by height (Z)
+    fig = plt.figure(figsize=(15,15))
+    ax = fig.add_subplot(111, projection='3d')
+    COL = { 'L':'r', 'R':'g'} ; MARKER = { 'L':'+', 'R':'x'} 
+    if 'SIDE' in dfPnt.columns:
+        for side in COL.keys():  #  L / R planar
+            pnt = dfPnt[dfPnt.SIDE==side]
+            ax.scatter( pnt.x, pnt.y, pnt.z, c=COL[side], alpha=0.7, rasterized=RASTER )
+        if 'inlier' in dfPnt.columns:
+            pnt = dfPnt[dfPnt.inlier!=True]
+            ax.scatter( pnt.x, pnt.y, pnt.z, c='k', marker='x', alpha=0.5, s=120,
+                        rasterized=RASTER )
+    else:
+        sc = ax.scatter( dfPnt.x,dfPnt.y,dfPnt.z,c=dfPnt.z,cmap=cm,s=10,marker='o',
+                         rasterized=RASTER )
+        cbar = plt.colorbar( sc )
+    ax.scatter( *PntXYZ, c='b', s=400, alpha=0.5 )
+    if RIDGE is not None:
+        for side,col in COL.items():
+            pnt = sko.Points( RIDGE[RIDGE.SIDE==side][XYZ].to_numpy() )
+            ax.scatter( pnt[:,0],pnt[:,1],pnt[:,2], s=300, lw=0.5,
+                        marker=MARKER[side],color=col, alpha=0.7 )  
+    ax.set_box_aspect((1, 1, Z_ASPECT)) 
+    ax.set_xlabel('X axis'); ax.set_ylabel('Y axis'); ax.set_zlabel('Z axis')
+    ax.set_title( TITLE )
+    if PLOT_FILE is None: plt.show()
+    else: print(f'Plotting {PLOT_FILE}...'); plt.savefig(PLOT_FILE)
+    plt.clf(); plt.close()
+
+def RenderPlot( PLOT_PKL ):
+    ''' render a plot from fit data saved by GableRoof.SavePlot(), the pickle
+        is removed once rendered, failed ones are kept in CACHE/PLOT '''
+    with open( PLOT_PKL, 'rb' ) as fd:
+        PLOT = pickle.load( fd )
+    PlotRoof( **PLOT )
+    Path( PLOT_PKL ).unlink()
+    return PLOT['PLOT_FILE']
 class GableRoof:
     """ Levelled gabel roof estation from lidar point-cloud. User input 
         point-clud fall onto the two planes of gabel roof. Software will
@@ -43,6 +95,9 @@ class GableRoof:
         self.YAML['RADIUS'] = np.sqrt( (BAS/2)**2+(LEN/2)**2 ) 
 
         assert( self.YAML['VERSION']==VERSION ) 
+        if not self.YAML.get('FLIGHT_LINE'):
+            raise Warning( '***ERROR*** no FLIGHT_LINE with usable LCP in YAML, '\
+                           'check MINPOINTS skipped by ChkStrip_LCP.py ...' )
         lcp = list()   # restructure YAML a bit
         for k,v in self.YAML['FLIGHT_LINE'].items():
             df = pd.DataFrame( v,  columns=['LCP', 'x','y','h', 'azi'] )
@@ -58,11 +113,64 @@ class GableRoof:
         if len( self.dfLCP )==0:
             raise Warning( 'No LCP is selected !!!')
 
+    def __getstate__(self):
+        ''' pickled to --jobs workers, the open YAML file is replaced by its name '''
+        state = self.__dict__.copy()
+        state['ARGS'] = argparse.Namespace( **vars(self.ARGS) )
+        state['ARGS'].YAML = getattr( self.ARGS.YAML, 'name', self.ARGS.YAML )
+        return state
+
     def IterateLCP(self):
-        result = list()
-        for i,row in self.dfLCP.iterrows(): 
+        STRIPS = list( self.dfLCP.groupby( 'FLIGHT_LINE', sort=False ) )
+        JOBS = min( self.ARGS.jobs, len(STRIPS) )
+        if JOBS>1 and self.ARGS.plot:
+            print( '***WARNING*** interactive --plot is done serially, --jobs ignored ...' )
+            JOBS = 1
+        if self.ARGS.render in ('deferred','background'):   # stale from earlier runs
+            for pkl in Path( 'CACHE/PLOT' ).glob( '*.pkl' ): pkl.unlink()
+        RENDER = None         # background : render as soon as a strip is done
+        if self.ARGS.render=='background':
+            RENDER = ProcessPoolExecutor( max_workers=1, initializer=_InitWorker )
+        result = list() ; plots = list() ; rendering = list()
+        def Collect( strip_result ):
+            result.extend( strip_result[0] )                    # YAML order
+            if RENDER is None: plots.extend( strip_result[1] )
+            else: rendering.extend( RENDER.submit( RenderPlot, f ) for f in strip_result[1] )
+        if JOBS>1:
+            print( f'Estimating LCPs of {len(STRIPS)} strips with {JOBS} processes ...' )
+            with ProcessPoolExecutor( max_workers=JOBS, initializer=_InitWorker ) as pool:
+                for strip_result in pool.map( self.EstimateStrip, *zip(*STRIPS) ):
+                    Collect( strip_result )
+        else:
+            for FLT_LINE,dfFLT in STRIPS:
+                Collect( self.EstimateStrip( FLT_LINE, dfFLT ) )
+        if RENDER is not None:
+            print( f'Waiting for {len(rendering)} plots rendered in background ...' )
+            for fut in rendering: fut.result()
+            RENDER.shutdown()
+        if len(plots):   # deferred 
+            print( f'Rendering {len(plots)} deferred plots ...' )
+            with ProcessPoolExecutor( max_workers=max(1,self.ARGS.jobs), 
+                                      initializer=_InitWorker ) as pool:
+                list( pool.map( RenderPlot, plots ) )
+        dfRESULT = pd.DataFrame( result, columns=COL_DXYZ  )
+        gdfRESULT = gpd.GeoDataFrame( dfRESULT, crs='epsg:32647', 
+                        geometry=gpd.points_from_xy( dfRESULT.x, dfRESULT.y ) )
+        return gdfRESULT
+
+    def EstimateStrip(self, FLT_LINE, dfFLT ):
+        ''' all LCPs of a flight-line, one job of --jobs. Return result rows
+            and fit data files of plots left to the render worker '''
+        result = list() ; plots = list()
+        if self.ARGS.cache:  # per LCP in DoEstimateLCP()
+            CIRCLES = [None]*len(dfFLT)
+        else:                # read flight-line once for all its LCPs
+            CIRCLES = self.ReadTargets( FLT_LINE, dfFLT )
+        for (i,row),dfCIRC in zip( dfFLT.iterrows(), CIRCLES ):
             print(f'===================== LCP : {row.LCP} =======================')
-            gdfPC, dfRIDGE =  self.DoEstimateLCP( [row.x,row.y,row.azi] , row.FLIGHT_LINE )
+            SEED = zlib.crc32( f'{row.FLIGHT_STEM}|{row.LCP}'.encode() )  # reproducible RANSAC
+            dfPC, dfRIDGE =  self.DoEstimateLCP( [row.x,row.y,row.azi] , 
+                                                  row.FLIGHT_LINE, dfCIRC, SEED=SEED )
             for side in ('L','R','LR' ):
                 if side == 'LR':
                     df = dfRIDGE[XYZ].copy()
@@ -82,56 +190,52 @@ class GableRoof:
 
             print( f'Best estimate {row.LCP} : {x:,.3f}, {y:,.3f}, {z:.3f} m')
             TITLE = f'{row.LCP}@{Path(row.FLIGHT_LINE)}'
-            PLOT_FILE = f'CACHE/{row.LCP}_{Path(row.FLIGHT_LINE).stem}.svg'
-            self.PlotRoof( dfRIDGE[XYZ].mean(),gdfPC,dfRIDGE,
-                            TITLE=TITLE,PLOT_FILE=PLOT_FILE)
-            if ARGS.plot:
-                gr.PlotRoof( dfRIDGE[XYZ].mean(),gdfPC,dfRIDGE,TITLE=TITLE,PLOT_FILE=None)
-
-        dfRESULT = pd.DataFrame( result, columns=COL_DXYZ  )
-        gdfRESULT = gpd.GeoDataFrame( dfRESULT, crs='epsg:32647', 
-                        geometry=gpd.points_from_xy( dfRESULT.x, dfRESULT.y ) )
-        return gdfRESULT
+            PLOT_FILE = f'CACHE/{row.LCP}_{Path(row.FLIGHT_LINE).stem}.{self.ARGS.plot_fmt}'
+            if self.ARGS.render=='inline':
+                self.PlotRoof( dfRIDGE[XYZ].mean(),dfPC,dfRIDGE,
+                                TITLE=TITLE,PLOT_FILE=PLOT_FILE)
+            elif self.ARGS.render in ('deferred','background'):
+                plots.append( self.SavePlot( dfRIDGE[XYZ].mean(),dfPC,dfRIDGE,
+                                TITLE,PLOT_FILE ) )
+            if self.ARGS.plot:
+                self.PlotRoof( dfRIDGE[XYZ].mean(),dfPC,dfRIDGE,TITLE=TITLE,PLOT_FILE=None)
+        return result, plots
 
-    def DoEstimateLCP(self, LCP, FLT_LINE ):
+    def DoEstimateLCP(self, LCP, FLT_LINE, dfCIRC=None, SEED=None ):
         BAS,WID,LEN = self.YAML['BASE'],self.YAML['WIDTH'],self.YAML['LENGTH']
         HEI,RAD     = self.YAML['HEIGHT'],self.YAML['RADIUS']
-        print( f'Reading point cloud by flight-line : "{FLT_LINE}"... ')
         self.LCP_APPROX = LCP
         X,Y,AZI = LCP[0],LCP[1],np.radians(LCP[2])
         self.FLT_LINE  =  FLT_LINE
-        if self.ARGS.cache: # hidden option for debugging pupose
-            gdfCIRC = self.ReadTarget_CACHE( self.FLT_LINE, X, Y )
+        if dfCIRC is not None:  # already read by ReadTargets()
+            pass
+        elif self.ARGS.cache: # hidden option for debugging pupose
+            dfCIRC = self.ReadTarget_CACHE( self.FLT_LINE, X, Y )
         else:
-            gdfCIRC = self.ReadTarget( self.FLT_LINE, X, Y )
-        bnd =gdfCIRC.total_bounds
-        pnt_sqm = len(gdfCIRC)/((bnd[2]-bnd[0])*(bnd[3]-bnd[1]) )
+            dfCIRC = self.ReadTarget( self.FLT_LINE, X, Y )
+        bnd = [ dfCIRC.x.min(), dfCIRC.y.min(), dfCIRC.x.max(), dfCIRC.y.max() ]
+        pnt_sqm = len(dfCIRC)/((bnd[2]-bnd[0])*(bnd[3]-bnd[1]) )
         print( f'Target circle size (meter) : {bnd[2]-bnd[0]:.1f} x {bnd[3]-bnd[1]:.1f} ' )
-        print( f'Point cloud on target circle : {len(gdfCIRC):,} ({pnt_sqm:.1f} pnt/sqm)')
-        if ARGS.plot: self.PlotRoof([LCP[0],LCP[1],gdfCIRC.z.max()],gdfCIRC,
+        print( f'Point cloud on target circle : {len(dfCIRC):,} ({pnt_sqm:.1f} pnt/sqm)')
+        if self.ARGS.plot: self.PlotRoof([LCP[0],LCP[1],dfCIRC.z.max()],dfCIRC,
                     TITLE=f'Target {LCP[0]:.1f},{LCP[1]:.1f}  Circle {self.BUFF_CIRC:.1f}m')
         ##################################################################
+        # roof panels in LCP frame, lx across and ly along the ridge 
         BFLR, BFRD = self.YAML['BUFF_LFRT'], self.YAML['BUFF_RIDGE']
-        def RoofPanel( side ):
-            SG = {'L':-1,'R':+1 } 
-            x0 = SG[side]*(BAS/2)*BFLR[0] ; x1 = SG[side]*(BAS/2)*BFLR[1]
-            ridge = shpgeom.LineString( [(x0,-BFRD*LEN/2),(x0,+BFRD*LEN/2) ]) 
-            poly = ridge.buffer( x0-x1, cap_style=2, single_sided=True )
-            poly = affinity.translate( poly, xoff=X, yoff=Y )
-            poly = affinity.rotate( poly, -AZI, origin=(X,Y), use_radians=True)
-            return poly
-        polyL= RoofPanel('L'); polyR= RoofPanel('R')
-        #plt.plot(*polyL.exterior.xy); plt.plot(*polyR.exterior.xy) ; plt.show()
-        dfpoly = pd.DataFrame( {'SIDE':['L','R'],'geometry':[polyL,polyR] } )
-        gdfpoly = gpd.GeoDataFrame( dfpoly, crs='epsg:32647', geometry=dfpoly.geometry )
-        gdfPC = gpd.sjoin( gdfCIRC, gdfpoly, how='inner', predicate='intersects')
-        gdfPC.reset_index( drop=True, inplace=True)
-        gdfPC.drop(['index_right'],axis=1,inplace=True )
+        c,s = np.cos(AZI), np.sin(AZI)
+        dx = dfCIRC.x.to_numpy()-X ; dy = dfCIRC.y.to_numpy()-Y
+        lx = c*dx - s*dy ; ly = s*dx + c*dy
+        x0,x1 = (BAS/2)*BFLR[0], (BAS/2)*BFLR[1]
+        ALONG = np.abs(ly)<=BFRD*LEN/2
+        SIDE = np.select( [ ALONG&(lx>=-x1)&(lx<=-x0), ALONG&(lx>=x0)&(lx<=x1) ], 
+                          [ 'L', 'R' ], default='' )
+        dfPC = dfCIRC[ SIDE!='' ].assign( SIDE=SIDE[SIDE!=''] )
+        dfPC.reset_index( drop=True, inplace=True)
         #if ARGS.plot:
-        #    self.PlotRoof( [LCP[0],LCP[1],gdfPC.z.max()] ,gdfPC,
+        #    self.PlotRoof( [LCP[0],LCP[1],dfPC.z.max()] ,dfPC,
         #                        TITLE='partioning roof into two planes' )
-        gdfPC, dfRIDGE = self.FitRoof( gdfPC ) 
-        return gdfPC, dfRIDGE 
+        dfPC, dfRIDGE = self.FitRoof( dfPC, SEED=SEED ) 
+        return dfPC, dfRIDGE 
 
     def ReadTarget_CACHE( self, FLI_LIN, X, Y ):
         LAS_CIRCLE = Path( 'CACHE/gdfCIRCLE.pkl')
@@ -145,77 +249,60 @@ class GableRoof:
         return gdfCIRCLE
 
     def ReadTarget( self, FLI_LIN, X, Y ):
-        with laspy.open( FLI_LIN, 'r') as fh:
-            las = fh.read()
-            dfLAS = pd.DataFrame( {'x':list(las.x), 'y':list(las.y) , 'z':list(las.z),
-                                  'intensity': las.intensity } )
-        minx,miny,maxx,maxy=shpgeom.Point( X,Y ).\
-                        buffer(self.BUFF_CIRC*self.YAML['RADIUS']).bounds
-        dfLAS = dfLAS[(dfLAS.x>minx)&(dfLAS.x<maxx)&(dfLAS.y>miny)&(dfLAS.y<maxy)]
-        gdfLAS = gpd.GeoDataFrame( dfLAS, crs='epsg:32647', 
-                         geometry=gpd.points_from_xy( dfLAS.x,dfLAS.y) )
-        return gdfLAS
-
-    def FitRoof( self, gdfPC ):
+        dfXY = pd.DataFrame( {'x':[X], 'y':[Y] } )
+        return self.ReadTargets( FLI_LIN, dfXY )[0]
+
+    def ReadTargets( self, FLI_LIN, dfXY ):
+        ''' one pass over FLI_LIN, target circles of all LCPs at dfXY.x/y '''
+        print( f'Reading point cloud by flight-line : "{FLI_LIN}" '\
+               f'for {len(dfXY)} LCP(s) ... ')
+        R = self.BUFF_CIRC*self.YAML['RADIUS']
+        BBOXES = [ (X-R,Y-R,X+R,Y+R) for X,Y in zip( dfXY.x, dfXY.y ) ]
+        return ReadWindows( FLI_LIN, BBOXES )  # only the windows are kept
+
+    def FitRoof( self, dfPC, SEED=None ):
+        dfPC['inlier'] = False
         PC = list()  
         for side in ['L','R']:
-            dfpnt = gdfPC[gdfPC.SIDE==side].copy()
-            plane = pyrsc.Plane()
-            best_eq,best_inliers = plane.fit( dfpnt[XYZ].to_numpy() , 
-                minPoints = self.YAML['MINPOINTS'], thresh = self.YAML['THRESH'], 
-                    maxIteration = self.YAML['MAXITER'])
+            dfpnt = dfPC[dfPC.SIDE==side].copy()
+            best_eq,best_inliers,niter = PlaneRANSAC( dfpnt[XYZ].to_numpy(), 
+                self.YAML['THRESH'], MAXITER=self.YAML['MAXITER'], 
+                MINPOINTS=self.YAML['MINPOINTS'], SEED=SEED )
             npnt = len(dfpnt);  nout = npnt-len(best_inliers); nperc=100*nout/npnt 
-            print(f'Fit plane "{side}" outliers : {nperc:.1f}% ({nout}/{npnt})')  
-            idx_gdfPC = dfpnt.iloc[ best_inliers ].index 
-            gdfPC.loc[ idx_gdfPC ,'inlier'] = True
-            # compare pyransac3d with skpatial, not compatible !!! 
-            pnt_sk = gdfPC[(gdfPC.SIDE==side)&(gdfPC.inlier==True)].copy()
-            pnt_sk.drop(['geometry'],axis=1,inplace=True )
-            pln_sk = sko.Plane.best_fit( pnt_sk[XYZ].to_numpy(), tol=None )
-            #print(f'Plane equation by pyransac3d {len(best_inliers)}pt : {best_eq}' ) 
-            #print(f'Plane equation by skspatial {len(pnt_sk)}pt : {pln_sk.cartesian()}' ) 
+            print(f'Fit plane "{side}" outliers : {nperc:.1f}% ({nout}/{npnt}) '\
+                  f'after {niter} hypotheses')  
+            idx_dfPC = dfpnt.iloc[ best_inliers ].index 
+            dfPC.loc[ idx_dfPC ,'inlier'] = True
+            pnt_sk = dfPC[(dfPC.SIDE==side)&(dfPC.inlier==True)].copy()
+            # least-squares refit on inliers is done by PlaneRANSAC
+            pln_sk = sko.Plane( pnt_sk[XYZ].mean().to_numpy(), best_eq[:3] )
             PC.append( [side,pnt_sk,npnt,nout, pln_sk] )
         dfROOF = pd.DataFrame( PC, columns=\
                        ['side','pnt_sk', 'npnt','nout','plane_sk'] )
         VectRidge = dfROOF.iloc[0].plane_sk.intersect_plane( dfROOF.iloc[1].plane_sk )
-        for _,row in dfROOF.iterrows():
-            def RidgeProjecting( pnt_row, vect ):
-                pnt = vect.project_point( [pnt_row.x,pnt_row.y, pnt_row.z] )
-                return pnt[0],pnt[1],pnt[2]
-            row.pnt_sk[XYZ] = row.pnt_sk.apply( RidgeProjecting, 
-                                  axis=1, result_type='expand', args=(VectRidge,)  )
+        P0 = np.asarray( VectRidge.point ) ; U = np.asarray( VectRidge.direction )
+        U = U/np.linalg.norm(U)
+        for _,row in dfROOF.iterrows():   # project inliers onto ridge line
+            PNT = row.pnt_sk[XYZ].to_numpy()-P0
+            row.pnt_sk[XYZ] = P0 + np.outer( PNT@U, U )
         dfRIDGE = pd.concat( [dfROOF.pnt_sk.iloc[0], dfROOF.pnt_sk.iloc[1] ] )
-        return gdfPC, dfRIDGE
+        return dfPC, dfRIDGE
 
     ########################################################################
     def PlotRoof(self,PntXYZ,dfPnt,RIDGE=None,TITLE=None,PLOT_FILE=None ):
-        Z_ASPECT = 0.5
-        cm = plt.cm.get_cmap('RdYlBu_r')  # color by height (Z)
-        fig = plt.figure(figsize=(15,15))
-        ax = fig.add_subplot(111, projection='3d')
-        COL = { 'L':'r', 'R':'g'} ; MARKER = { 'L':'+', 'R':'x'} 
-        if 'SIDE' in dfPnt.columns:
-            for side in COL.keys():  #  L / R planar
-                pnt = dfPnt[dfPnt.SIDE==side]
-                ax.scatter( pnt.x, pnt.y, pnt.z, c=COL[side], alpha=0.7 )
-            if 'inlier' in dfPnt.columns:
-                pnt = dfPnt[dfPnt.inlier!=True]
-                ax.scatter( pnt.x, pnt.y, pnt.z, c='k', marker='x', alpha=0.5, s=120 )
-        else:
-            sc = ax.scatter( dfPnt.x,dfPnt.y,dfPnt.z,c=dfPnt.z,cmap=cm,s=10,marker='o')
-            cbar = plt.colorbar( sc )
-        ax.scatter( *PntXYZ, c='b', s=400, alpha=0.5 )
-        if RIDGE is not None:
-            for side,col in COL.items():
-                pnt = sko.Points( RIDGE[RIDGE.SIDE==side][XYZ].to_numpy() )
-                ax.scatter( pnt[:,0],pnt[:,1],pnt[:,2], s=300, lw=0.5,
-                            marker=MARKER[side],color=col, alpha=0.7 )  
-        ax.set_box_aspect((1, 1, Z_ASPECT)) 
-        ax.set_xlabel('X axis'); ax.set_ylabel('Y axis'); ax.set_zlabel('Z axis')
-        ax.set_title( TITLE )
-        if PLOT_FILE is None: plt.show()
-        else: print(f'Plotting {PLOT_FILE}...'); plt.savefig(PLOT_FILE)
-        plt.clf(); plt.close()
+        PlotRoof( PntXYZ, dfPnt, RIDGE=RIDGE, TITLE=TITLE, PLOT_FILE=PLOT_FILE,
+                  MAX_PNT=self.ARGS.plot_max, RASTER=self.ARGS.raster )
+
+    def SavePlot(self,PntXYZ,dfPnt,RIDGE,TITLE,PLOT_FILE ):
+        ''' fit data of a plot for the render worker, return pickle file '''
+        PLOT_PKL = Path( 'CACHE/PLOT' ).joinpath( Path(PLOT_FILE).stem+'.pkl' )
+        PLOT_PKL.parent.mkdir( parents=True, exist_ok=True )
+        PLOT = { 'PntXYZ': list(PntXYZ), 'dfPnt': dfPnt[ XYZ+['SIDE','inlier'] ], 
+                 'RIDGE': RIDGE[ XYZ+['SIDE'] ], 'TITLE': TITLE, 'PLOT_FILE': PLOT_FILE,
+                 'MAX_PNT': self.ARGS.plot_max, 'RASTER': self.ARGS.raster }
+        with open( PLOT_PKL, 'wb' ) as fd:
+            pickle.dump( PLOT, fd )
+        return PLOT_PKL
 
 #######################################################################
 if __name__=="__main__":
@@ -231,8 +318,20 @@ if __name__=="__main__":
             help='limit processing by specifying strip name')
     parser.add_argument('-l','--lcp', action='store', 
             help='limit processing only LCP ,otherwise process all LCPs')
+    parser.add_argument('-j','--jobs', action='store', type=int, default=1,
+            help='number of processes, strips are estimated in parallel')
+    parser.add_argument('-r','--render', action='store', choices=PLOT_POLICY, 
+            default='inline', help='plot files of fitted LCPs : "inline" while '\
+            'estimating, "off", "deferred" after all strips or "background" process')
+    parser.add_argument('--plot_max', action='store', type=int, default=PLOT_MAX,
+            help=f'decimate point cloud to plot, default {PLOT_MAX:,} points')
+    parser.add_argument('--plot_fmt', action='store', choices=['svg','pdf','png'], 
+            default='svg', help='format of plot files, default "svg"')
+    parser.add_argument('--raster', action='store_true', 
+            help='rasterize point scatters in vector svg/pdf plot')
     ARGS = parser.parse_args()
     print( ARGS )
+    plt.switch_backend( 'TkAgg' if ARGS.plot else 'Agg' )  # headless unless --plot
     gr = GableRoof( ARGS )
     gdfRESULT = gr.IterateLCP()
 
@@ -0,0 +1,190 @@
+#
+#
+#   Las_Lib : windowed reading of lidar flight-lines (.las/.laz). Points are read
+#             chunk by chunk and only those inside a bounding box are kept,
+#             the box is tested on the scaled integer X/Y of the records so
+#             peak memory follows the window, not the strip.
+#             A grid index '<las>.lasgrid.npz' is built once per strip, it
+#             lists for every grid cell the pages (runs of GRID_PAGE points)
+#             having points in the cell, a window then seeks only to those
+#             pages. The index is rebuilt whenever the LAS size/mtime change.
+#             CountGrid/GridPolygon give the footprint of a strip from a
+#             streamed count grid.
+#             LAZ is decompressed chunk by chunk, in parallel with lazrs if
+#             available, it is never expanded on disk.
+#
+#  Author: Phisan Santitamnont
+#          Faculty of Engineer, Chulalongkorn University
+#
+import numpy as np
+import pandas as pd
+import laspy
+import shapely
+from pathlib import Path
+
+CHUNK = 1_000_000     # points per chunk
+GRID_CELL = 5.0       # metre
+GRID_PAGE = 65_536    # points per page of the grid index
+GRID_VERSION = 1
+LAZ_BACKEND = [ be for be in ( laspy.LazBackend.LazrsParallel, laspy.LazBackend.Lazrs,
+                               laspy.LazBackend.Laszip ) if be.is_available() ]
+
+def OpenLas( LAS ):
+    ''' laspy reader of .las or .laz, LAZ with the fastest backend installed '''
+    return laspy.open( LAS, mode='r', laz_backend=LAZ_BACKEND )
+
+#############################################################################
+def IntBounds( header, BBOX ):
+    ''' BBOX (minx,miny,maxx,maxy) in scaled integer record units, widened by
+        one unit so that the exact test on float x/y can follow '''
+    (sx,sy,_),(ox,oy,_) = header.scales, header.offsets
+    minx,miny,maxx,maxy = BBOX
+    return ( np.floor( (minx-ox)/sx )-1, np.floor( (miny-oy)/sy )-1,
+             np.ceil(  (maxx-ox)/sx )+1, np.ceil(  (maxy-oy)/sy )+1 )
+
+def InHeader( header, BBOX ):
+    minx,miny,maxx,maxy = BBOX
+    (hx0,hy0,_),(hx1,hy1,_) = header.mins, header.maxs
+    return not ( maxx<hx0 or minx>hx1 or maxy<hy0 or miny>hy1 )
+
+def WindowPoints( points, header, BBOX ):
+    ''' DataFrame x,y,z,intensity of points strictly inside BBOX '''
+    minx,miny,maxx,maxy = BBOX
+    X0,Y0,X1,Y1 = IntBounds( header, BBOX )
+    X,Y = points.X, points.Y
+    sel = np.flatnonzero( (X>=X0)&(X<=X1)&(Y>=Y0)&(Y<=Y1) )
+    pnt = points[sel]
+    df = pd.DataFrame( { 'x': np.asarray(pnt.x), 'y': np.asarray(pnt.y),
+                         'z': np.asarray(pnt.z), 'intensity': np.asarray(pnt.intensity) } )
+    return df[ (df.x>minx)&(df.x<maxx)&(df.y>miny)&(df.y<maxy) ]
+
+#############################################################################
+def _LasKey( LAS ):
+    st = Path( LAS ).stat()
+    return np.array( [ GRID_VERSION, st.st_size, st.st_mtime_ns ], dtype=np.int64 )
+
+def GridIndexFile( LAS ):
+    return Path( f'{LAS}.lasgrid.npz' )
+
+def BuildGridIndex( LAS, CELL=GRID_CELL, PAGE=GRID_PAGE ):
+    ''' one pass over LAS, CSR of pages per cell i.e. pages of cell c are
+        CELL_PAGE[ CELL_OFFSET[c]:CELL_OFFSET[c+1] ] with c = iy*NX+ix '''
+    print( f'Building grid index of "{LAS}" ...' )
+    cell_page = list()
+    with OpenLas( LAS ) as fh:
+        (X0,Y0,_),(X1,Y1,_) = fh.header.mins, fh.header.maxs
+        NX = int( (X1-X0)//CELL )+1 ; NY = int( (Y1-Y0)//CELL )+1
+        NPNT = fh.header.point_count
+        for ipage,points in enumerate( fh.chunk_iterator( PAGE ) ):
+            ix = np.clip( ( (np.asarray(points.x)-X0)//CELL ).astype(np.int64), 0, NX-1 )
+            iy = np.clip( ( (np.asarray(points.y)-Y0)//CELL ).astype(np.int64), 0, NY-1 )
+            cells = np.unique( iy*NX+ix )
+            cell_page.append( np.column_stack( [ cells, np.full_like( cells, ipage ) ] ) )
+    cell_page = np.concatenate( cell_page ) if cell_page else np.zeros( (0,2), dtype=np.int64 )
+    cell_page = cell_page[ np.lexsort( (cell_page[:,1], cell_page[:,0]) ) ]
+    return { 'LAS_KEY'     : _LasKey( LAS ),
+             'GRID'        : np.array( [ X0, Y0, CELL ] ),
+             'SHAPE'       : np.array( [ NX, NY, PAGE, NPNT ], dtype=np.int64 ),
+             'CELL_OFFSET' : np.searchsorted( cell_page[:,0], np.arange( NX*NY+1 ) ),
+             'CELL_PAGE'   : cell_page[:,1].astype( np.int32 ) }
+
+def GridIndex( LAS, CELL=GRID_CELL, PAGE=GRID_PAGE ):
+    ''' read the sidecar grid index of LAS, (re)build it if missing or stale '''
+    IDX_FILE = GridIndexFile( LAS )
+    if IDX_FILE.exists():
+        with np.load( IDX_FILE ) as npz:
+            idx = { k: npz[k] for k in npz.files }
+        if np.array_equal( idx['LAS_KEY'], _LasKey( LAS ) ) and \
+                idx['GRID'][2]==CELL and idx['SHAPE'][2]==PAGE:
+            return idx
+        print( f'Grid index "{IDX_FILE}" is stale ...' )
+    idx = BuildGridIndex( LAS, CELL=CELL, PAGE=PAGE )
+    try:
+        np.savez( IDX_FILE, **idx )
+    except OSError as e:   # read-only strip directory, keep in memory
+        print( f'***WARNING*** cannot write "{IDX_FILE}" : {e}' )
+    return idx
+
+def WindowPages( idx, BBOX ):
+    ''' sorted pages of the grid index having points in cells under BBOX '''
+    X0,Y0,CELL = idx['GRID'] ; NX,NY = map( int, idx['SHAPE'][:2] )
+    minx,miny,maxx,maxy = BBOX
+    ix0,iy0 = int( (minx-X0)//CELL ), int( (miny-Y0)//CELL )
+    ix1,iy1 = int( (maxx-X0)//CELL ), int( (maxy-Y0)//CELL )
+    if ix1<0 or iy1<0 or ix0>=NX or iy0>=NY: return np.zeros( 0, dtype=np.int32 )
+    ix = np.arange( max(ix0,0), min(ix1,NX-1)+1 )
+    iy = np.arange( max(iy0,0), min(iy1,NY-1)+1 )
+    cells = ( iy[:,None]*NX+ix[None,:] ).ravel()
+    OFF,PG = idx['CELL_OFFSET'], idx['CELL_PAGE']
+    return np.unique( np.concatenate( [ PG[OFF[c]:OFF[c+1]] for c in cells ] ) )
+
+def PageRuns( idx, pages ):
+    ''' list of (first_point, n_point) covering sorted unique pages '''
+    PAGE,NPNT = map( int, idx['SHAPE'][2:] )  # python int, laspy seek() is slow on numpy int
+    if len(pages)==0: return []
+    brk = np.flatnonzero( np.diff( pages )>1 )+1        # consecutive pages merged
+    runs = list()
+    for run in np.split( pages, brk ):
+        first = int(run[0])*PAGE
+        runs.append( ( first, min( (int(run[-1])+1)*PAGE, NPNT )-first ) )
+    return runs
+
+def _IterRuns( fh, runs, CHUNK ):
+    for first,npnt in runs:
+        fh.seek( first )
+        while npnt>0:
+            points = fh.read_points( min( CHUNK, npnt ) )
+            npnt -= len(points)
+            yield points
+
+def ReadWindows( LAS, BBOXES, CHUNK=CHUNK, INDEX=True ):
+    ''' read LAS once for all BBOXES=[(minx,miny,maxx,maxy),...], return list
+        of DataFrame x,y,z,intensity, one per BBOX. With INDEX only pages
+        listed by the grid index for the union of windows are read, otherwise
+        whole LAS is streamed in chunks '''
+    dfs = [ list() for _ in BBOXES ]
+    with OpenLas( LAS ) as fh:
+        hit = [ i for i,BBOX in enumerate( BBOXES ) if InHeader( fh.header, BBOX ) ]
+        if len(hit):
+            if INDEX:
+                idx = GridIndex( LAS )
+                pages = np.unique( np.concatenate( [ WindowPages( idx, BBOXES[i] ) for i in hit ] ) )
+                chunks = _IterRuns( fh, PageRuns( idx, pages ), CHUNK )
+            else:
+                chunks = fh.chunk_iterator( CHUNK )
+            for points in chunks:
+                for i in hit:
+                    dfs[i].append( WindowPoints( points, fh.header, BBOXES[i] ) )
+    EMPTY = pd.DataFrame( columns=['x','y','z','intensity'], dtype=float )
+    return [ pd.concat( df, ignore_index=True ) if len(df) else EMPTY.copy() for df in dfs ]
+
+def ReadWindow( LAS, BBOX, CHUNK=CHUNK, INDEX=True ):
+    ''' keep points of LAS inside BBOX=(minx,miny,maxx,maxy) '''
+    return ReadWindows( LAS, [BBOX], CHUNK=CHUNK, INDEX=INDEX )[0]
+
+#############################################################################
+def CountGrid( LAS, CELL, CHUNK=CHUNK ):
+    ''' stream LAS, number of points per CELL x CELL, return COUNT (NY,NX)
+        and GRID=(X0,Y0,CELL) of the lower-left corner, origin snapped to
+        multiple of CELL so that grids of all strips are aligned '''
+    with OpenLas( LAS ) as fh:
+        (X0,Y0,_),(X1,Y1,_) = fh.header.mins, fh.header.maxs
+        X0 = np.floor( X0/CELL )*CELL ; Y0 = np.floor( Y0/CELL )*CELL
+        NX = int( (X1-X0)//CELL )+1 ; NY = int( (Y1-Y0)//CELL )+1
+        COUNT = np.zeros( NX*NY, dtype=np.int64 )
+        for points in fh.chunk_iterator( CHUNK ):
+            ix = np.clip( ( (np.asarray(points.x)-X0)//CELL ).astype(np.int64), 0, NX-1 )
+            iy = np.clip( ( (np.asarray(points.y)-Y0)//CELL ).astype(np.int64), 0, NY-1 )
+            COUNT += np.bincount( iy*NX+ix, minlength=NX*NY )
+    return COUNT.reshape( NY,NX ).astype( np.int32 ), np.array( [ X0, Y0, CELL ] )
+
+def GridPolygon( COUNT, GRID, MIN_COUNT=1 ):
+    ''' coverage (Multi)Polygon of cells having MIN_COUNT points, runs of
+        occupied cells along rows are boxed then unioned '''
+    OCC = np.pad( COUNT>=MIN_COUNT, ( (0,0),(1,1) ) ).astype( np.int8 )
+    RUN = np.diff( OCC, axis=1 )
+    iy,ix0 = np.nonzero( RUN==+1 )     # row-major, start/end pairs align
+    _ ,ix1 = np.nonzero( RUN==-1 )
+    X0,Y0,CELL = GRID
+    boxes = shapely.box( X0+ix0*CELL, Y0+iy*CELL, X0+ix1*CELL, Y0+(iy+1)*CELL )
+    return shapely.union_all( boxes )
@@ -0,0 +1,65 @@
+#
+#
+#   Ransac_Lib : RANSAC plane fitting for the panels of a gable-roof LCP.
+#                Hypotheses are drawn and scored in batches with numpy,
+#                iteration stops adaptively once the best inlier ratio
+#                reaches the requested confidence, the plane is finally
+#                refitted by least-squares onto its inliers.
+#
+#  Author: Phisan Santitamnont
+#          Faculty of Engineer, Chulalongkorn University
+#
+import numpy as np
+
+BATCH = 64          # hypotheses scored at once
+CONFIDENCE = 0.999  # probability of one all-inlier sample
+
+#############################################################################
+def _Trials( w, CONF=CONFIDENCE ):
+    ''' number of 3-point samples to get an all-inlier one with CONF '''
+    if w>=1.: return 0
+    p = w**3
+    if p<=0.: return np.inf
+    return np.log( 1.-CONF )/np.log( 1.-p )
+
+def PlaneLSQ( XYZ ):
+    ''' least-squares plane, return centroid and unit normal '''
+    cen = XYZ.mean( axis=0 )
+    _,_,vt = np.linalg.svd( XYZ-cen, full_matrices=False )
+    return cen, vt[-1]
+
+def PlaneRANSAC( XYZ, THRESH, MAXITER=1000, MINPOINTS=3, CONF=CONFIDENCE,
+                 BATCH=BATCH, SEED=None ):
+    ''' fit plane to XYZ (N,3) at distance THRESH, at most MAXITER hypotheses.
+        Return plane equation [a,b,c,d] with unit normal, index of inliers
+        and number of hypotheses scored '''
+    XYZ = np.asarray( XYZ, dtype=float )
+    N = len(XYZ)
+    if N<3:
+        raise Warning( f'***ERROR*** plane fitting needs at least 3 points, got {N} ...' )
+    rng = np.random.default_rng( SEED )
+    PNT = XYZ-XYZ.mean( axis=0 )         # centred, better conditioned
+    best_cnt = 0 ; best_in = None ; trials = MAXITER ; it = 0
+    while it<min( trials, MAXITER ):
+        B = min( BATCH, MAXITER-it ) ; it += B
+        SMP = PNT[ rng.integers( 0, N, size=(B,3) ) ]                 # B,3,3
+        NRM = np.cross( SMP[:,1]-SMP[:,0], SMP[:,2]-SMP[:,0] )
+        LEN = np.linalg.norm( NRM, axis=1 )
+        ok = LEN>1e-12                                                # degenerate
+        if not ok.any(): continue
+        NRM = NRM[ok]/LEN[ok,None]
+        D = -np.einsum( 'ij,ij->i', NRM, SMP[ok,0] )
+        INLIER = np.abs( PNT@NRM.T+D )<=THRESH                       # N,B
+        cnt = INLIER.sum( axis=0 )
+        k = cnt.argmax()
+        if cnt[k]>best_cnt:
+            best_cnt = cnt[k] ; best_in = INLIER[:,k]
+            trials = _Trials( best_cnt/N, CONF )
+    if best_in is None:
+        raise Warning( '***ERROR*** plane fitting, all samples are degenerated ...' )
+    if best_cnt<MINPOINTS:
+        print( f'***WARNING*** plane fitting found only {best_cnt} inliers, '\
+               f'less than MINPOINTS={MINPOINTS} ...' )
+    inliers = np.flatnonzero( best_in )
+    cen,nrm = PlaneLSQ( XYZ[inliers] )
+    return np.append( nrm, -nrm@cen ), inliers, it
@@ -6,14 +6,16 @@
 #  P.Santitamnont ( 4 Dec 2022 )
 #
 #
-import datetime
-import numpy as np 
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import geopandas as gpd
 from pathlib import Path
 from exif import Image
+from RigCheck_Lib import ValidateRig, PrintReport
 
 EXIF_DT_FMT = '%Y:%m:%d %H:%M:%S'
+RIG_POSITION = [ 'S', 'A', 'D', 'W', 'X' ]
 
 ##########################################################################
 def ReadAllJPEG( PATH_JPEG ):
@@ -29,68 +31,96 @@ def ReadAllJPEG( PATH_JPEG ):
 
     df = pd.DataFrame( data, columns=[ 'ImagePath',  'ImageName', 
                 'RigPos', 'RigName', 'dt_digitized', 'orient' ] )
-    def MakeDT(row):
-        dt = pd.to_datetime( row.dt_digitized, format=EXIF_DT_FMT )
-        return dt
-    df['dt'] = df.apply( MakeDT, axis=1 )
+    df['dt'] = pd.to_datetime( df.dt_digitized, format=EXIF_DT_FMT )
     return df
 
 ##########################################################################
 def AdjustExifDateTime( df, INCR_SEC=1 ):
     ''' Pix4D prefers ADSWX '''
-    adj_row = [] ; error_5cam = []
-    RUN_NO = 0
-    RUN_DT = df.dt.min() 
-    for rig_name, row in df.groupby( 'RigName' ):
-        print( rig_name )
-        if len(row)!=5:
-            #print( f'@@@@@@@@@@@@@@@@@ rig name = {rig_name} @@@@@@@@@@@@@@@@@@@')
-            #print( '*** ERROR *** number images in rig is not 5!...')
-            error_5cam.append( row.ImageName.to_list() )
-        if len(row.dt_digitized.unique()) != 1 and len(row)==5:
-            #print( f'@@@@@@@@@@@@@@@@@ rig name = {rig_name} @@@@@@@@@@@@@@@@@@@')
-            #print( '*** ERROR *** datetime_digitized not the same, adjusting to median()...')
-            assert( int(rig_name)>RUN_NO ) 
-            if INCR_SEC is None:
-                dtAdj = row['dt'].median()
-            else:
-                dtAdj = RUN_DT + datetime.timedelta( seconds=INCR_SEC )
-            row['dtAdj'] = dtAdj 
-            #import pdb ; pdb.set_trace()
-            #assert( dtAdj.timestamp() > RUN_DT )
-            adj_row.append( row )
-            RUN_DT = dtAdj
-            RUN_NO = int(rig_name)
+    report = ValidateRig( df, RIG_POSITION, RIG='RigName', POS='RigPos', DT='dt', 
+                          INCR_SEC=INCR_SEC )
+    PrintReport( report )
+    dfAdj = report['adjusted']
     print(f'Total JPEG ={len(df):,} ' )
-    NRIG = len(adj_row)
+    NRIG = dfAdj.RigName.nunique()
     print(f'Total rig = {NRIG:,d}   head = {NRIG*5:,}...' )
+    error_5cam = report['rig'][ report['rig'].n!=5 ]
     print(f'Total errors ERROR_5CAM={len(error_5cam)} and will be exclueded ...' )
-    print( error_5cam )
-    return pd.concat( adj_row )
+    print( error_5cam.index.to_list() )
+    return dfAdj
 
 ##########################################################################
-def ModifyCopyJPEG( dfADJ_DT, DO_COPY=False ):
-    for i,row in dfADJ_DT.iterrows():
+EXIF_ASCII = { 0x0132: 'datetime', 0x8298: 'copyright', 
+               0x9003: 'datetime_original', 0x9004: 'datetime_digitized' }
+def FindExifASCII( JPEG ):
+    ''' locate the ASCII tags EXIF_ASCII in IFD0 and Exif-IFD of the APP1 
+        segment, return { name : (file offset, byte count) } '''
+    with open( JPEG, 'rb' ) as fd:
+        head = fd.read( 262144 )
+    if head[0:2]!=b'\xff\xd8': return {}
+    pos = 2
+    while pos+4<=len(head) and head[pos]==0xFF:
+        marker, seglen = head[pos+1], int.from_bytes( head[pos+2:pos+4], 'big' )
+        if marker==0xE1 and head[pos+4:pos+10]==b'Exif\x00\x00': break
+        if marker==0xDA: return {}    # start of scan, no APP1/Exif
+        pos += 2+seglen
+    else:
+        return {}
+    TIFF = pos+10 ; tiff = head[TIFF:pos+2+seglen]
+    BO = { b'II':'little', b'MM':'big' }.get( tiff[0:2] )
+    if BO is None: return {}
+    def U( off, n ): return int.from_bytes( tiff[off:off+n], BO )
+    found = {} ; ifds = [ U(4,4) ]
+    while ifds:
+        ifd = ifds.pop()
+        if ifd+2>len(tiff): return {}
+        for i in range( U(ifd,2) ):
+            ent = ifd+2+12*i
+            tag,typ,cnt = U(ent,2), U(ent+2,2), U(ent+4,4)
+            if tag==0x8769:          # Exif-IFD pointer
+                ifds.append( U(ent+8,4) )
+            elif tag in EXIF_ASCII and typ==2:
+                off = ent+8 if cnt<=4 else U(ent+8,4)
+                found[ EXIF_ASCII[tag] ] = ( TIFF+off, cnt )
+    return found
+
+def PatchCopyJPEG( infile, outfile, EXIF_VAL ):
+    ''' copy JPEG and patch fixed-length ASCII tags in place without decoding
+        the image, fall back to a full rewrite by "exif" when a tag is missing
+        or its field is too short. Return 'patch' or 'rewrite' '''
+    found = FindExifASCII( infile )
+    vals = { k: v.encode('ascii')+b'\x00' for k,v in EXIF_VAL.items() }
+    if all( k in found and len(v)<=found[k][1] for k,v in vals.items() ):
+        shutil.copyfile( infile, outfile )
+        with open( outfile, 'r+b' ) as fd:
+            for k,v in vals.items():
+                off,cnt = found[k]
+                fd.seek( off ) ; fd.write( v.ljust( cnt, b'\x00' ) )
+        return 'patch'
+    with open( infile, 'rb' ) as fd_in:
+        img = Image( fd_in )
+        for k,v in EXIF_VAL.items():
+            setattr( img, k, v )
+        with open( outfile, 'wb' ) as fd_out:
+            fd_out.write( img.get_file() )
+    return 'rewrite'
+
+def ModifyCopyJPEG( dfADJ_DT, DO_COPY=False, WORKERS=8 ):
+    if DO_COPY==False:
+        print('>>> SIMULATION no actual JPEG created ...<<<' )
+    def DoModify( row ):
         infile = row.ImagePath
         outfile = Path('./CACHE').joinpath( infile )
         dtAdj = row.dtAdj.strftime( EXIF_DT_FMT )
-        print( dtAdj )
-        if DO_COPY==False:
-            print('>>> SIMULATION no actual JPEG created ...<<<' )
-        print( f'Reading original JPEG {infile} ...' )
-        print( f'Update metadata EXIF_DateTime "{dtAdj}"..')
-        print( f'Writing modified JPEG {outfile} ...' )
-        ##############################################
-        if DO_COPY:
-            outfile.parent.mkdir(parents=True, exist_ok=True) 
-            with open( infile, 'rb' ) as fd_in:
-                img = Image( fd_in )
-                img.copyright = 'MEA@Dec.2022'
-                img.datetime           = dtAdj
-                img.datetime_digitized = dtAdj
-                img.datetime_original  = dtAdj
-                with open( outfile, 'wb' ) as fd_out:
-                    fd_out.write( img.get_file() )
+        print( f'Modify {infile} EXIF_DateTime "{dtAdj}" -> {outfile} ...' )
+        if not DO_COPY: return 'simulate'
+        outfile.parent.mkdir(parents=True, exist_ok=True) 
+        EXIF_VAL = { 'copyright': 'MEA@Dec.2022', 'datetime': dtAdj,
+                     'datetime_digitized': dtAdj, 'datetime_original': dtAdj }
+        return PatchCopyJPEG( infile, outfile, EXIF_VAL )
+    with ThreadPoolExecutor( max_workers=WORKERS ) as pool:
+        done = list( pool.map( DoModify, [ row for _,row in dfADJ_DT.iterrows() ] ) )
+    print( pd.Series( done ).value_counts() )
      
 ###########################################################################
 ###########################################################################
@@ -100,18 +130,11 @@ dfAllJPEG = ReadAllJPEG( PATH_JPEG )
 dfAdjDT = AdjustExifDateTime( dfAllJPEG, INCR_SEC=1 )
 
 ###########################################################################
-dt_rig = []  ; dtPrev = None
-for grp_rig, row in dfAdjDT.groupby('RigName'):
-    assert( len(row)==5 )
-    assert( sorted( row.RigPos.to_list()) == ['A', 'D', 'S', 'W', 'X'] )
-    diffs = (row.dtAdj - row.iloc[0].dtAdj).dt.total_seconds().to_list()
-    assert(  np.allclose( diffs, 0.0) )
-    if dtPrev is None:
-        dtPrev = row.iloc[0].dtAdj
-    else:
-        dt_rig.append( (row.iloc[0].dtAdj-dtPrev).total_seconds() )
+report = ValidateRig( dfAdjDT, RIG_POSITION, RIG='RigName', POS='RigPos', DT='dtAdj' )
+assert( report['rig'].complete.all() and (report['rig'].spread_sec==0).all() )
+assert( report['rig'].dt_min.is_monotonic_increasing )
 print( f'Recheck all {len( dfAdjDT):,} rig passed !!!...' )
-print( dt_rig )
+print( report['rig'].dt_min.diff().dt.total_seconds().dropna().to_list() )
 print( dfAdjDT )
 ###########################################################################
 ModifyCopyJPEG( dfAdjDT, DO_COPY=True )
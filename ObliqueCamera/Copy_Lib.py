@@ -0,0 +1,102 @@
+#
+#
+# Copy_Lib.py : copy/link photos of oblique rigs into CACHE, shared by
+#               CopyRegion.py, Pix4D_Lib.py and RetrievObliq.py. Files are
+#               copied concurrently, identical files are skipped and every
+#               finished file is appended to a manifest so that an
+#               interrupted export restarts where it stopped.
+# Author : P.Santitamnont (Phisan.Chula@gmail.com)
+#
+#
+import os,shutil
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import pandas as pd
+
+COPY_MODE = [ 'copy', 'hardlink', 'symlink' ]
+
+##########################################################################################
+def _KernelCopy( src, dst ):
+    ''' copy_file_range() lets the kernel/filesystem copy (reflink, server-side
+        copy on NFS/SMB), otherwise shutil which uses sendfile() on Linux '''
+    if not hasattr( os, 'copy_file_range' ):
+        shutil.copyfile( src, dst ) ; return
+    with open( src, 'rb' ) as fsrc, open( dst, 'wb' ) as fdst:
+        try:
+            while os.copy_file_range( fsrc.fileno(), fdst.fileno(), 1<<30 ) > 0:
+                pass
+        except OSError:      # e.g. EXDEV/ENOSYS on older kernel
+            fsrc.seek(0) ; fdst.seek(0) ; fdst.truncate()
+            shutil.copyfileobj( fsrc, fdst, 1<<24 )
+
+def _IsSame( src_st, dst, MODE='copy' ):
+    ''' dst already holds src in the form of MODE, a symlink left by an earlier
+        symlink run is not a copy nor a hardlink and vice versa '''
+    if dst.is_symlink()!=( MODE=='symlink' ):
+        return False
+    try:
+        dst_st = dst.stat()
+    except FileNotFoundError:
+        return False
+    if (src_st.st_dev,src_st.st_ino)==(dst_st.st_dev,dst_st.st_ino):
+        return True
+    return (src_st.st_size,src_st.st_mtime_ns)==(dst_st.st_size,dst_st.st_mtime_ns)
+
+def _IsDone( src, dst, MODE='copy' ):
+    ''' manifest entry still valid i.e. dst exists and matches src '''
+    try:
+        return _IsSame( Path(src).stat(), Path(dst), MODE )
+    except FileNotFoundError:
+        return False
+
+def CopyOne( src, dst, MODE='copy' ):
+    ''' copy or link src to dst, return "skip" when dst is already identical '''
+    src,dst = Path(src), Path(dst)
+    st = src.stat()
+    if _IsSame( st, dst, MODE ): return 'skip'
+    dst.parent.mkdir( parents=True, exist_ok=True )
+    if dst.exists() or dst.is_symlink(): dst.unlink()
+    if MODE=='symlink':
+        dst.symlink_to( src.resolve() ) ; return MODE
+    if MODE=='hardlink':
+        try:
+            os.link( src, dst ) ; return MODE
+        except OSError:      # other filesystem, fall back to copy
+            pass
+    _KernelCopy( src, dst )
+    os.utime( dst, ns=( st.st_atime_ns, st.st_mtime_ns ) )  # identical next time
+    return 'copy'
+
+def CopyPhotos( SRC, DST, MODE='copy', WORKERS=8, MANIFEST=None ):
+    ''' copy lists of SRC to DST concurrently, MODE in COPY_MODE. Finished
+        files are appended to MANIFEST which is consulted first on restart.
+        Return DataFrame of src, dst and status '''
+    if MODE not in COPY_MODE:
+        raise Warning( f'***ERROR*** unknown copy mode "{MODE}", expecting {COPY_MODE}...')
+    df = pd.DataFrame( { 'src': [ str(s) for s in SRC ], 'dst': [ str(d) for d in DST ] } )
+    df['status'] = None
+    done = set()
+    if MANIFEST is not None:
+        MANIFEST = Path( MANIFEST )
+        if MANIFEST.exists():
+            with open( MANIFEST, 'r' ) as fd:
+                done = set( tuple( line.rstrip('\n').split('\t') ) for line in fd )
+            resume = [ (s,d) in done and _IsDone( s, d, MODE ) for s,d in zip( df.src, df.dst ) ]
+            df.loc[ resume, 'status' ] = 'done'
+            print( f'Resuming from manifest "{MANIFEST}", {sum(resume):,} files done ...')
+        MANIFEST.parent.mkdir( parents=True, exist_ok=True )
+    todo = df.index[ df.status.isna() ]
+    print( f'Copying ({MODE}) {len(todo):,} files with {WORKERS} workers ...' )
+    fd = open( MANIFEST, 'a' ) if MANIFEST is not None else None
+    try:
+        with ThreadPoolExecutor( max_workers=WORKERS ) as pool:
+            futures = { pool.submit( CopyOne, df.src[i], df.dst[i], MODE ): i for i in todo }
+            for fut in as_completed( futures ):
+                i = futures[fut]
+                df.loc[i,'status'] = fut.result()
+                if fd is not None:
+                    fd.write( f'{df.src[i]}\t{df.dst[i]}\n' ) ; fd.flush()
+    finally:
+        if fd is not None: fd.close()
+    print( df.status.value_counts().to_string() )
+    return df
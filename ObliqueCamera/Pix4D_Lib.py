@@ -7,14 +7,17 @@
 # Version : 0.3  ( 2022-12-14 )
 #
 #
-import shutil,re
+import hashlib
 from pathlib import Path
 from shapely.geometry import box,LineString,Polygon
 import numpy as np 
 import pandas as pd
 import geopandas as gpd
-import scipy.optimize 
 import tomli
+from Copy_Lib import CopyPhotos
+
+BLOCK_CACHE_VERSION = 1   # bump when the layout of the cached block changes
+SINGULAR_TOL = 1e-12      # relative |det| of the ray/plane system
 
 ##########################################################################################
 class Pix4dBlock:
@@ -30,74 +33,191 @@ class Pix4dBlock:
         PROJCS = list( PIX4D_PATH.glob('./1_initial/params/*_wkt.prj') )[0]
         with open (PROJCS, 'r') as f : self.PROJCS = f.read()
         #############################################
-        PMATRIX = list(PIX4D_PATH.glob('./1_initial/params/*_pmatrix.txt'))[0]
-        dfPMat = pd.read_csv( PMATRIX, delim_whitespace=True, header=None )
-        def MakeMat( row ):
-            return  np.matrix( row[1:13] ).reshape( 3,4 )
-        dfPMat['PMat' ]= dfPMat.apply( MakeMat, axis=1)
+        PARAMS = { 'PMATRIX': '*_pmatrix.txt', 
+                   'EXT_PAR': '*_calibrated_external_camera_parameters.txt',
+                   'OFFSET' : '*_offset.xyz' }
+        PARAMS = { k: list( PIX4D_PATH.glob(f'./1_initial/params/{v}') )[0] 
+                            for k,v in PARAMS.items() }
+        JPG_DIRS = sorted( d for d in PIX4D_PATH.glob('./*/*') if d.is_dir() )
+        BLOCK_KEY = self.BlockKey( PIX4D_PATH, [ *PARAMS.values(), *JPG_DIRS ] )
+        BLOCK_NPZ = self.CACHE.joinpath( f'./dfPix4dBlock_{PIX4D_PATH.resolve().name}.npz' )
+        if not self.ReadBlockCache( BLOCK_NPZ, BLOCK_KEY ):
+            print( f'Parsing Pix4D parameters and caching "{BLOCK_NPZ}" ...' )
+            self.ParseBlock( PIX4D_PATH, PARAMS )
+            self.WriteBlockCache( BLOCK_NPZ, BLOCK_KEY )
+        if self.dfImage.JPG_Path.isna().all(): 
+            print( '***WARING*** no directory of JPG images ...')
+        self.dfImage = gpd.GeoDataFrame( self.dfImage, crs='EPSG:32647', 
+                       geometry=gpd.points_from_xy( self.dfImage.X, self.dfImage.Y, self.dfImage.Z ) )
+        self.PMAT_IDX = dict( zip( self.dfImage.ImageStem, range(len(self.dfImage)) ) )
+
+    def ParseBlock( self, PIX4D_PATH, PARAMS ):
+        ''' parse P-matrices, external parameters, rig names, offset and 
+            JPG paths of the block into self.dfImage, self.PMAT and self.OFFSET '''
+        dfPMat = pd.read_csv( PARAMS['PMATRIX'], delim_whitespace=True, header=None )
+        PMAT = dfPMat.iloc[:,1:13].to_numpy( dtype=float ).reshape( -1,3,4 )
+        dfPMat['iPMat'] = np.arange( len(dfPMat) )
         #############################################
         dfJPG = pd.DataFrame( list(PIX4D_PATH.glob('./*/*/*.JPG')), columns=['JPG_Path'] )
-        if len(dfJPG)==0: 
-            print( '***WARING*** no directory of JPG images ...')
+        dfJPG['ImageName'] = [ jpg.name for jpg in dfJPG.JPG_Path ]
+        #############################################
+        dfExt = pd.read_csv( PARAMS['EXT_PAR'],  delim_whitespace=True )
+        dfImage = pd.merge( dfExt, dfPMat[[0,'iPMat']] , how='inner', left_on='imageName', right_on=0 )
+        dfImage.drop( labels=[0], axis=1, inplace=True )
+        dfImage.rename( columns={'imageName': 'ImageName' } ,inplace=True )
+        dfImage = pd.merge( dfImage, dfJPG.drop_duplicates('ImageName'), how='left', on='ImageName' )
         #############################################
-        EXT_PAR = list(PIX4D_PATH.glob('./1_initial/params/*_calibrated_external_camera_parameters.txt'))[0]
-        dfExt = pd.read_csv( EXT_PAR,  delim_whitespace=True )
-        dfImage = pd.merge( dfExt, dfPMat[[0,'PMat']] , how='inner', left_on='imageName', right_on=0 )
-        #if len(dfJPG)>0:
-        #    dfImage = pd.merge( dfImage, dfJPG , how='inner', left_on='imageName', right_on='ImageName' )
-        self.dfImage = gpd.GeoDataFrame( dfImage, crs='EPSG:32647', 
-                       geometry=gpd.points_from_xy( dfImage.X, dfImage.Y, dfImage.Z ) )
-        self.dfImage.drop( labels=[0], axis=1, inplace=True )
-        self.dfImage.rename( columns={'imageName': 'ImageName' } ,inplace=True )
-        #import pdb ; pdb.set_trace()
-        def MakeRig( row, self ):
-            ImageStem =  row.ImageName.split('.')[0]
-            RigName = re.sub('.*?([0-9]*)$',r'\1',ImageStem)
-            RigPos = ImageStem[0:-len(RigName)] 
-            if RigPos not in self.CONFIG['RIG_POSITION']:
-                raise print(f'***ERROR*** unknown prefix "{ImageStem}" ...')
-            return  [ ImageStem, row.ImageName , RigName, RigPos ]
-        self.dfImage[ [ 'ImageStem', 'ImageName', 'RigName', 'RigPos' ] ] = \
-                       self.dfImage.apply( MakeRig, axis=1, result_type='expand' , args=(self,) ) 
-        self.dfImage.sort_values( by=['RigName','RigPos'], inplace=True )
+        dfImage['ImageStem'] = dfImage.ImageName.str.split('.').str[0]
+        dfRig = dfImage.ImageStem.str.extract( r'^(?P<RigPos>.*?)(?P<RigName>[0-9]*)$' )
+        unknown = ~dfRig.RigPos.isin( self.CONFIG['RIG_POSITION'] )
+        if unknown.any():
+            print(f'***ERROR*** unknown prefix "{dfImage.ImageStem[unknown].to_list()}" ...')
+            raise Warning( '***ERROR*** unknown rig position ...' )
+        dfImage[ ['RigName', 'RigPos'] ] = dfRig[ ['RigName', 'RigPos'] ]
+        dfImage.sort_values( by=['RigName','RigPos'], inplace=True )
+        dfImage.reset_index( drop=True, inplace=True )
+        # contiguous (N,3,4) P-matrices follow the row order of dfImage
+        self.PMAT = np.ascontiguousarray( PMAT[ dfImage.iPMat.to_numpy() ] )
+        self.dfImage = dfImage.drop( labels=['iPMat'], axis=1 )
         #############################################
-        OFFSET = list( PIX4D_PATH.glob('./1_initial/params/*_offset.xyz') )[0]
-        self.OFFSET = np.matrix( np.loadtxt( OFFSET ) ).T
+        self.OFFSET = np.matrix( np.loadtxt( PARAMS['OFFSET'] ) ).T
+
+    def BlockKey( self, PIX4D_PATH, FILES ):
+        ''' hash of path, size and mtime of the files the block is parsed from,
+            any change of a params file or a JPG directory invalidates the cache '''
+        key = hashlib.sha1( f'{BLOCK_CACHE_VERSION}|{PIX4D_PATH.resolve()}'.encode() )
+        for f in FILES:
+            st = f.stat()
+            key.update( f'|{f.relative_to(PIX4D_PATH)}|{st.st_size}|{st.st_mtime_ns}'.encode() )
+        return key.hexdigest()
 
-    def CopyRigImage( self, RIG_NAME ):
+    def ReadBlockCache( self, BLOCK_NPZ, BLOCK_KEY ):
+        if not BLOCK_NPZ.exists(): return False
+        with np.load( BLOCK_NPZ, allow_pickle=False ) as npz:
+            if str( npz['BLOCK_KEY'] ) != BLOCK_KEY:
+                print( f'Stale block cache "{BLOCK_NPZ}" ...' )
+                return False
+            print( f'Reading cached block "{BLOCK_NPZ}" ...' )
+            self.PMAT = npz['PMAT']
+            self.OFFSET = np.matrix( npz['OFFSET'] )
+            self.dfImage = pd.DataFrame( { col: npz[f'COL_{col}'] for col in npz['COLUMNS'] } )
+        self.dfImage['JPG_Path'] = pd.Series( [ Path(p) if len(p) else np.nan 
+                                    for p in self.dfImage.JPG_Path ], dtype=object )
+        return True
+
+    def WriteBlockCache( self, BLOCK_NPZ, BLOCK_KEY ):
+        df = self.dfImage.copy()
+        df['JPG_Path'] = df.JPG_Path.fillna('').astype(str)
+        COLS = { f'COL_{col}': df[col].to_numpy( dtype=float if df[col].dtype.kind=='f' else str ) 
+                                for col in df.columns }
+        np.savez( BLOCK_NPZ, BLOCK_KEY=BLOCK_KEY, PMAT=self.PMAT, OFFSET=np.asarray(self.OFFSET),
+                  COLUMNS=np.array( df.columns, dtype=str ), **COLS )
+
+    def CopyRigImage( self, RIG_NAME, MODE='copy' ):
         if type(RIG_NAME) is str: 
             dfIMAGE = self.dfImage[self.dfImage.RigName==RIG_NAME]
         else: 
             dfIMAGE = RIG_NAME
-        for grp,row in dfIMAGE.groupby( 'RigName' ):
-            CACHE_RIG = self.CACHE.joinpath(f'./{grp}')
-            CACHE_RIG.mkdir(parents=True, exist_ok=True)
-            for _,img in row.iterrows(): 
-                src = img.JPG_Path 
-                dst = CACHE_RIG.joinpath( img.ImageName )
-                print( f'CopyRigImage: copying  {src} to {dst}...' )
-                shutil.copyfile( src, dst ) 
+        dfIMAGE = dfIMAGE[ dfIMAGE.JPG_Path.notna() ]
+        print( f'CopyRigImage: copying {len(dfIMAGE):,} images to {self.CACHE}/<rig> ...' )
+        DST = [ self.CACHE.joinpath( f'./{rig}/{name}' ) 
+                    for rig,name in zip( dfIMAGE.RigName, dfIMAGE.ImageName ) ]
+        return CopyPhotos( dfIMAGE.JPG_Path, DST, MODE=MODE, 
+                           MANIFEST=self.CACHE.joinpath( 'CopyRigImage.manifest' ) )
+
+    def ImageIndex( self, IMAGE_STEMS ):
+        ''' positional index of images into self.PMAT and self.dfImage '''
+        try:
+            return np.array( [ self.PMAT_IDX[stem] for stem in IMAGE_STEMS ], dtype=int )
+        except KeyError as e:
+            raise Warning( f'***ERROR*** cannot find {e.args[0]} ...')
 
     def World2Image( self, IMAGE_STEM, XYZ ):
         ''' calculate undistorted image coordinate from object coordinate'''
-        df = self.dfImage[ self.dfImage.ImageStem==IMAGE_STEM ]
-        if len(df)!=1:
+        if IMAGE_STEM not in self.PMAT_IDX:
             raise Warning( f'***ERROR*** cannot find {IMAGE_STEM} ...')
-        XYZ_ = XYZ - self.OFFSET
-        XYZt = df.iloc[0].PMat * np.vstack( [XYZ_,[[1.]]] )
-        uv = XYZt[0,0]/XYZt[2,0], XYZt[1,0]/XYZt[2,0]
+        XYZ_ = np.asarray( XYZ - self.OFFSET ).ravel()
+        XYZt = self.PMAT[ self.PMAT_IDX[IMAGE_STEM] ] @ np.append( XYZ_, 1. )
+        uv = XYZt[0]/XYZt[2], XYZt[1]/XYZt[2]
         return uv
 
+    def World2Image_Batch( self, XYZ, IMAGE_STEMS=None ):
+        ''' project M object points XYZ (M,3) into K images in one broadcast,
+            all images of the block if IMAGE_STEMS is None. Return undistorted 
+            image coordinates UV (K,M,2) and DEPTH (K,M), the homogeneous scale
+            which is positive for points in front of the camera '''
+        if IMAGE_STEMS is None:
+            PM = self.PMAT
+        else:
+            PM = self.PMAT[ self.ImageIndex( IMAGE_STEMS ) ]
+        XYZ_ = np.atleast_2d( np.asarray( XYZ, dtype=float ) ) - np.asarray( self.OFFSET ).ravel()
+        XYZt = np.einsum( 'kij,mj->kmi', PM[:,:,0:3], XYZ_ ) + PM[:,None,:,3]
+        DEPTH = XYZt[:,:,2]
+        UV = XYZt[:,:,0:2]/DEPTH[:,:,None]
+        return UV, DEPTH
+
+    def VisibleImages( self, XYZ, IMAGE_STEMS=None, CHUNK=4_000_000 ):
+        ''' exact visibility of object points XYZ (M,3) by projecting through
+            the P-matrices of all (or IMAGE_STEMS) images, keep images where a
+            point falls inside SENSOR_SIZE and in front of the camera. Points
+            are processed in chunks of CHUNK image-point pairs to bound memory.
+            Return long DataFrame per (point,image) with pixel (u,v), depth,
+            distance and obliquity i.e. off-nadir angle of the ray in degree '''
+        SX,SY = self.CONFIG['SENSOR_SIZE']
+        XYZ = np.atleast_2d( np.asarray( XYZ, dtype=float ) )
+        if IMAGE_STEMS is None:
+            IDX = np.arange( len(self.dfImage) )
+        else:
+            IDX = self.ImageIndex( IMAGE_STEMS )
+        STEMS = self.dfImage.ImageStem.to_numpy()[IDX]
+        CAM = self.dfImage[['X','Y','Z']].to_numpy()[IDX]
+        NPNT = max( 1, CHUNK//max( 1,len(IDX) ) )
+        dfs = []
+        for beg in range( 0, len(XYZ), NPNT ):
+            pnt = XYZ[beg:beg+NPNT]
+            UV,DEPTH = self.World2Image_Batch( pnt, STEMS )
+            with np.errstate( invalid='ignore' ):
+                vis = (DEPTH>0) & (UV[:,:,0]>=0) & (UV[:,:,0]<SX) & \
+                                  (UV[:,:,1]>=0) & (UV[:,:,1]<SY)
+            k,m = np.nonzero( vis )
+            ray = CAM[k]-pnt[m]
+            dist = np.linalg.norm( ray, axis=1 )
+            dfs.append( pd.DataFrame( { 'iPNT': beg+m, 'ImageStem': STEMS[k],
+                    'u': UV[k,m,0], 'v': UV[k,m,1], 'depth': DEPTH[k,m], 'dist_m': dist,
+                    'obliq_deg': np.degrees( np.arccos( np.clip( ray[:,2]/dist, -1, 1 ) ) ) } ) )
+        df = pd.concat( dfs, ignore_index=True )
+        df = pd.merge( df, self.dfImage[['ImageStem','RigPos','RigName']], how='left', on='ImageStem' )
+        return df.sort_values( by=['iPNT','obliq_deg'], kind='stable', ignore_index=True )
+
     def Image2World( self, IMAGE_STEM, UV, XY_APPROX, Z ):
         ''' calculate object coordinate XYZ from image (row,col) 
-            given Z must be prior known e.g. from DTM  '''
-        def Image2World_CB(  XY, IMAGE_STEM, UV, Z ):
-            XYZ = np.matrix( [*XY,Z] ).T
-            UV_ = np.array( self.World2Image( IMAGE_STEM, XYZ ) )
-            return UV_-np.array( UV )
-        X,Y = scipy.optimize.fsolve( Image2World_CB, XY_APPROX, 
-                                         args=( IMAGE_STEM,UV,Z) )
-        return X,Y,Z 
+            given Z must be prior known e.g. from DTM. XY_APPROX is kept
+            for compatibility, the ray/plane solution needs no approximation '''
+        X,Y,Z = self.Image2World_Batch( [IMAGE_STEM], [UV[0]], [UV[1]], [Z] )
+        return X[0],Y[0],Z[0] 
+
+    def Image2World_Batch( self, IMAGE_STEMS, U, V, Z ):
+        ''' vectorized Image2World, each (image,u,v,Z) is intersected with
+            the plane Z by solving the two linear equations of the P-matrix
+              (p1-u*p3).[X,Y,Z,1] = 0  and  (p2-v*p3).[X,Y,Z,1] = 0 
+            for (X,Y) directly, return arrays X,Y,Z. Rays (nearly) parallel
+            to the plane give a singular system and X,Y are NaN '''
+        IMAGE_STEMS = np.atleast_1d( IMAGE_STEMS )
+        U,V,Z = [ np.broadcast_to( np.asarray(a, dtype=float), IMAGE_STEMS.shape ) 
+                        for a in (U,V,Z) ]
+        PM = self.PMAT[ self.ImageIndex( IMAGE_STEMS ) ]
+        Z_ = Z - self.OFFSET[2,0]
+        A1 = PM[:,0,:] - U[:,None]*PM[:,2,:]     # (N,4)
+        A2 = PM[:,1,:] - V[:,None]*PM[:,2,:]
+        M = np.stack( [ A1[:,0:2], A2[:,0:2] ], axis=1 )          # (N,2,2)
+        b = -np.stack( [ A1[:,2]*Z_+A1[:,3], A2[:,2]*Z_+A2[:,3] ], axis=1 )
+        SCALE = np.linalg.norm( M[:,0], axis=1 )*np.linalg.norm( M[:,1], axis=1 )
+        OK = np.abs( np.linalg.det( M ) )>SINGULAR_TOL*SCALE
+        XY_ = np.full( ( len(M),2 ), np.nan )
+        XY_[OK] = np.linalg.solve( M[OK], b[OK,:,None] )[...,0]
+        X = XY_[:,0] + self.OFFSET[0,0]
+        Y = XY_[:,1] + self.OFFSET[1,0]
+        return X,Y,np.array( Z ) 
 
 #######################################################################################
 if __name__ == "__main__":
@@ -11,11 +11,10 @@ PlotBlock.py : plot BBA/AT resulting from Pix4D by reading 'parameters folder'
 #
 import shutil
 from pathlib import Path
-from shapely.geometry import box,LineString,Polygon
+import shapely
+from shapely.geometry import box
 import numpy as np 
-import pandas as pd
 import geopandas as gpd
-import scipy.optimize 
 import tomli
 from Pix4D_Lib import *
 
@@ -52,14 +51,13 @@ class PlotBlock(Pix4dBlock):
 
     def PlotBlock( self ):
         cen = self.dfImage[ self.dfImage.RigPos==self.CONFIG['RIG_POSITION'][0] ]
-        paths = []
-        for i in range( len(cen)-1 ):
-            paths.append(LineString( [cen.iloc[i].geometry,cen.iloc[i+1].geometry ] ) )    
+        xyz = shapely.get_coordinates( cen.geometry.values, include_z=True )
+        paths = shapely.linestrings( np.stack( [xyz[:-1],xyz[1:]], axis=1 ) )
         print(f'Plotting Pix4D block {self.BLOCK} ...' )
         if self.BLOCK.exists(): self.BLOCK.unlink()
 
         dfTraj = gpd.GeoDataFrame( crs='EPSG:32647', geometry=paths  )
-        COLS = list( set(cen.columns)-set( ['PMat','JPG_Path' ] ) )
+        COLS = list( set(cen.columns)-set( ['JPG_Path'] ) )
         dfTraj.to_file( self.BLOCK, driver='GPKG', layer='Trajectory' )  
         self.dfImage[COLS].to_file( self.BLOCK, driver='GPKG', layer='Image' ) 
 
@@ -67,32 +65,40 @@ class PlotBlock(Pix4dBlock):
         ''' ARG.rig number to plot or retrieve images XXX or XXX,YYY,ZZZ or XXX:ZZZ '\
                     'if None, all images will be plotted') '''
         print(f'Plotting foot-print over block {self.BLOCK} ...' )
-        fps = [] ; axis = [] ; centr = []
         SX,SY = self.CONFIG['SENSOR_SIZE']
         OFFSET = self.CONFIG['COV_TERRAIN'] if self.ARGS.terrain else self.CONFIG['COV_RELATIVE']
-        for _,row in dfIMAGE.iterrows():
-            if row.RigPos==self.CONFIG['RIG_POSITION'][0]:
-                print( f'Calculation foot-print for rig {row.RigName}' )
-            poly = [] 
-            for corner in list(box(0,0,SX,SY).exterior.coords):
-                xyz = self.Image2World( row.ImageStem, corner, [ row.X,row.Y ], Z=(row.Z-OFFSET) )
-                poly.append( xyz )
-            fps.append( [row.ImageStem, row.RigPos, row.RigName, Polygon(poly) ] )
-            ft_xyz = self.Image2World( row.ImageStem, [SX/2,SY/2], [row.X,row.Y], Z=(row.Z-OFFSET) )
-            axis.append( [ row.ImageStem, row.RigPos, row.RigName, 
-                           LineString( [(row.X,row.Y,row.Z), (ft_xyz[0],ft_xyz[1],ft_xyz[2]) ]) ] )
-            centr.append( [ row.ImageStem, row.RigPos, row.RigName,  Polygon(poly).centroid ] )
- 
-        dfFoot = pd.DataFrame( fps, columns=[ 'ImageStem','RigPos','RigName', 'geometry'] )
+        NIMG = len(dfIMAGE)
+        print( f'Calculation foot-print for {NIMG:,} images of '\
+               f'{dfIMAGE.RigName.nunique():,} rigs ...' )
+        # 5 corners of the closed sensor box followed by the sensor center,
+        # all images are intersected with their plane Z in one batch
+        UV = np.vstack( [ np.array( box(0,0,SX,SY).exterior.coords ), [[SX/2,SY/2]] ] )
+        NUV = len(UV)
+        X,Y,Z = self.Image2World_Batch( np.repeat( dfIMAGE.ImageStem.to_numpy(), NUV ),
+                        np.tile( UV[:,0], NIMG ), np.tile( UV[:,1], NIMG ), 
+                        np.repeat( dfIMAGE.Z.to_numpy()-OFFSET, NUV ) )
+        XYZ = np.stack( [X,Y,Z], axis=1 ).reshape( NIMG,NUV,3 )
+        OK = ~np.isnan( XYZ ).any( axis=(1,2) )   # rays parallel to the plane
+        if not OK.all():
+            print( f'***WARNING*** {(~OK).sum():,} images without foot-print, '\
+                   f'e.g. {dfIMAGE.ImageStem.to_numpy()[~OK][:5]} ...' )
+        XYZ = XYZ[OK]
+        polys = shapely.polygons( XYZ[:,0:NUV-1,:] )
+        axis = shapely.linestrings( np.stack( [ dfIMAGE[['X','Y','Z']].to_numpy()[OK], 
+                                                 XYZ[:,NUV-1,:] ], axis=1 ) )
+        centr = shapely.centroid( polys )
+        dfRig = dfIMAGE[[ 'ImageStem','RigPos','RigName' ]][OK].reset_index( drop=True )
+
+        dfFoot = dfRig.assign( geometry=polys )
         for group,row in dfFoot.groupby( 'RigPos' ):
             gdf = gpd.GeoDataFrame( row, crs='epsg:32647', geometry=row.geometry ) 
             gdf.to_file( self.BLOCK, driver='GPKG', layer=f'FootPrint_{group}' ) 
 
-        dfAxis = pd.DataFrame( axis, columns=[ 'ImageStem','RigPos','RigName','geometry'] )
+        dfAxis = dfRig.assign( geometry=axis )
         gdfAxis = gpd.GeoDataFrame( dfAxis, crs='epsg:32647', geometry=dfAxis.geometry )
         gdfAxis.to_file( self.BLOCK, driver='GPKG', layer='sensor_axis' )
         
-        dfCentr = pd.DataFrame( centr, columns=[ 'ImageStem','RigPos','RigName','geometry'] )
+        dfCentr = dfRig.assign( geometry=centr )
         gdfCentr = gpd.GeoDataFrame( dfCentr, crs='epsg:32647', geometry=dfCentr.geometry )
         gdfCentr.to_file( self.BLOCK, driver='GPKG', layer='centroid_poly' )
 
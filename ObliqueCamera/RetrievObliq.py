@@ -6,9 +6,60 @@ import geopandas as gpd
 from shapely.geometry import Point
 from sklearn.neighbors import KDTree
 from pathlib import Path
-import io
+import pickle,hashlib
 from Pix4D_Lib import *
 
+class TiePointIndex:
+    ''' inverted index of Pix4D tie-points held in CSR offset arrays, 
+        keypoint -> images : KP_IMAGE[ KP_OFFSET[k]:KP_OFFSET[k+1] ]
+        image -> keypoints : IM_KEYPNT[ IM_OFFSET[i]:IM_OFFSET[i+1] ] sorted 
+                             by column so a pixel window is a binary search '''
+    def __init__( self, dfTiePnt ):
+        # image names e.g. A0619.JPG are keyed by stem as ImageStem of dfImage
+        self.IMAGES = np.array( [ Path(img).stem for img in dfTiePnt.image.cat.categories ], dtype=str )
+        self.IMAGE_IDX = dict( zip( self.IMAGES, range(len(self.IMAGES)) ) )
+        KEY = dfTiePnt.keypnt.to_numpy( dtype=np.int64 )
+        IMG = dfTiePnt.image_code.to_numpy( dtype=np.int64 )
+        COL = dfTiePnt.col.to_numpy() ; ROW = dfTiePnt.row.to_numpy()
+        def Offset( idx, n ):
+            return np.concatenate( [[0], np.cumsum( np.bincount( idx, minlength=n ) )] )
+        order = np.argsort( KEY, kind='stable' )
+        self.KP_OFFSET = Offset( KEY, KEY.max()+1 if len(KEY) else 0 )
+        self.KP_IMAGE  = IMG[order]
+        order = np.lexsort( (COL,IMG) )
+        self.IM_OFFSET = Offset( IMG, len(self.IMAGES) )
+        self.IM_KEYPNT = KEY[order]
+        self.IM_COL, self.IM_ROW = COL[order], ROW[order]
+
+    def ImagesOfKeypoint( self, KEYPNT ):
+        ''' names of images observing keypoint KEYPNT '''
+        if KEYPNT<0 or KEYPNT>=len(self.KP_OFFSET)-1:
+            return self.IMAGES[:0]
+        beg,end = self.KP_OFFSET[KEYPNT], self.KP_OFFSET[KEYPNT+1]
+        return self.IMAGES[ self.KP_IMAGE[beg:end] ]
+
+    def KeypointsInWindow( self, IMAGE, COL, ROW, HALF_WIN ):
+        ''' keypoints of IMAGE (ImageStem) inside the window (COL,ROW)+/-HALF_WIN '''
+        IMAGE = Path( IMAGE ).stem
+        if IMAGE not in self.IMAGE_IDX:
+            raise Warning( f'***ERROR*** image "{IMAGE}" has no tie-point ...' )
+        i = self.IMAGE_IDX[IMAGE]
+        beg,end = self.IM_OFFSET[i], self.IM_OFFSET[i+1]
+        col = self.IM_COL[beg:end]
+        lo = beg + np.searchsorted( col, COL-HALF_WIN, side='left' )
+        hi = beg + np.searchsorted( col, COL+HALF_WIN, side='right' )
+        inwin = np.abs( self.IM_ROW[lo:hi]-ROW ) <= HALF_WIN
+        return self.IM_KEYPNT[lo:hi][inwin]
+
+    def TiedImages( self, KEYPNTS ):
+        ''' bulk keypoint -> images, long DataFrame of (keypnt,ImageStem) '''
+        KEYPNTS = np.asarray( KEYPNTS, dtype=np.int64 )
+        KEYPNTS = KEYPNTS[ (KEYPNTS>=0) & (KEYPNTS<len(self.KP_OFFSET)-1) ]
+        beg = self.KP_OFFSET[KEYPNTS] ; cnt = self.KP_OFFSET[KEYPNTS+1]-beg
+        pos = np.repeat( beg-np.cumsum(cnt)+cnt, cnt ) + np.arange( cnt.sum() )
+        return pd.DataFrame( { 'keypnt': np.repeat( KEYPNTS, cnt ),
+                               'ImageStem' : self.IMAGES[ self.KP_IMAGE[pos] ] } )
+
 class ObliqueView( Pix4dBlock ):
     def __init__(self, ARGS, PIX4D_PATH ):
         PIX4D_PATH = Path( PIX4D_PATH )
@@ -16,63 +67,168 @@ class ObliqueView( Pix4dBlock ):
         TP_FILE = list(PIX4D_PATH.glob('./params/*_tp_pix4d.txt'))[0]
         super().__init__( PIX4D_PATH )
         dfTiePnt = self.ReadP4D_TP( TP_FILE )
+        self.KDTrees = self.ReadKDTrees( FP_FILE )
+        self.dfTiePnt = dfTiePnt
+        self.TPIndex = TiePointIndex( dfTiePnt )
+        pass
+
+    def ReadKDTrees( self, FP_FILE ):
+        ''' one KDTree of foot-print centroids per rig position, serialized
+            next to FP_FILE and rebuilt only when FP_FILE changes '''
+        KD_FILE = FP_FILE.with_suffix( '.kdtree.pkl' )
+        st = FP_FILE.stat() ; KEY = ( st.st_size, st.st_mtime_ns )
+        if KD_FILE.exists():
+            with open( KD_FILE, 'rb' ) as fd:
+                kd = pickle.load( fd )
+            if kd['KEY']==KEY:
+                print( f'Reading cached KDTrees "{KD_FILE}" ...' )
+                return kd['KDTrees']
+        print( f'Building KDTrees from "{FP_FILE}" ...' )
         dfFootPr = gpd.read_file( FP_FILE, layer='centroid_poly' )
-        self.KDTrees = {}
-        for rig in ['S','A','D','W','X']:
+        KDTrees = {}
+        for rig in self.CONFIG['RIG_POSITION']:
             df = dfFootPr[dfFootPr.RigPos==rig].copy()
+            if len(df)==0:
+                print( f'***WARNING*** no foot-print for rig position "{rig}", skipped ...' )
+                continue
             df.reset_index( inplace=True )
-            pnts = df[df.RigPos==rig].geometry
-            self.KDTrees[rig] = [df, KDTree( np.array(list( zip( pnts.x,pnts.y )))) ]
-        self.dfTiePnt = dfTiePnt
-        self.dfFootPr = dfFootPr
-        pass
+            pnts = df.geometry
+            df = pd.DataFrame( df.drop( labels=['geometry'], axis=1 ) )
+            KDTrees[rig] = [df, KDTree( np.stack( [pnts.x,pnts.y], axis=1 ) ) ]
+        with open( KD_FILE, 'wb' ) as fd:
+            pickle.dump( { 'KEY': KEY, 'KDTrees': KDTrees }, fd )
+        return KDTrees
 
-    def ReadP4D_TP( self, TP_FILE ):
-        with open(TP_FILE, 'r') as tp:
-            IMG_BEG = 0
-            dfs = []
-            lines = tp.readlines()
-            for i,line in enumerate(lines):
-                if line.strip()=='-99':
-                    img_lines =  ''.join( lines[IMG_BEG+1:i] )
-                    df = pd.read_csv( io.StringIO( img_lines), delim_whitespace=True, 
-                           index_col=None, header=None, names=['col','row', 'qlt_key'] )
-                    df['image'] =  lines[IMG_BEG].strip()
-                    dfs.append( df )
-                    IMG_BEG = i+1
-        df = pd.concat ( dfs )
-        df.reset_index( drop=False, inplace=True) 
-        df.rename( columns={'index':'keypnt'} , inplace=True )
-        df['keypnt'] = df['keypnt'].astype(str)
+    def ReadP4D_TP( self, TP_FILE, SIDECAR=True, CHUNK=2_000_000 ):
+        ''' read Pix4D tie-points, blocks of "keypnt col row scale" lines each 
+            headed by an image name and closed by "-99", in one streaming pass
+            into compact columns. SIDECAR keeps a Parquet copy in CACHE which
+            is memory-mapped by later runs until TP_FILE changes i.e. the
+            sidecar is named by hash of path, size and mtime of TP_FILE '''
+        TP_FILE = Path( TP_FILE )
+        st = TP_FILE.stat()
+        TP_KEY = hashlib.sha1( f'{TP_FILE.resolve()}|{st.st_size}|{st.st_mtime_ns}'.encode() )
+        TP_PARQ = self.CACHE.joinpath( f'./{TP_FILE.stem}_{TP_KEY.hexdigest()[:16]}.parquet' )
+        if SIDECAR and TP_PARQ.exists():
+            print( f'Reading cached tie-points "{TP_PARQ}" ...' )
+            return pd.read_parquet( TP_PARQ, memory_map=True )
+        print( f'Reading tie-points "{TP_FILE}" ...' )
+        IMAGES = {} ; dfs = [] ; CODE = -1
+        reader = pd.read_csv( TP_FILE, sep=r'\s+', header=None, index_col=False,
+                    names=['keypnt','col','row','qlt_key'], chunksize=CHUNK,
+                    dtype={'keypnt':str, 'col':np.float32, 'row':np.float32, 'qlt_key':np.float32} )
+        for df in reader:
+            is_pnt = df.col.notna().to_numpy()
+            is_img = ~is_pnt & (df.keypnt!='-99').to_numpy()
+            code = np.full( len(df), np.nan )
+            code[is_img] = [ IMAGES.setdefault( img, len(IMAGES) ) for img in df.keypnt[is_img] ]
+            code = pd.Series( code ).ffill().fillna( CODE ).to_numpy()
+            CODE = code[-1]
+            df = df[is_pnt]
+            dfs.append( pd.DataFrame( { 'keypnt' : df.keypnt.to_numpy( dtype=np.int32 ),
+                             'col': df.col.to_numpy(), 'row': df.row.to_numpy(), 
+                             'qlt_key': df.qlt_key.to_numpy(), 
+                             'image_code': code[is_pnt].astype( np.int32 ) } ) )
+        df = pd.concat( dfs, ignore_index=True )
+        df['image'] = pd.Categorical.from_codes( df.image_code, categories=list(IMAGES) )
+        if SIDECAR:
+            for old in self.CACHE.glob( f'{TP_FILE.stem}_*.parquet' ):   # stale sidecars
+                if len( old.stem )==len( TP_PARQ.stem ): old.unlink()
+            try:
+                df.to_parquet( TP_PARQ, index=False )
+            except ImportError:
+                print( f'***WARNING*** no Parquet engine, "{TP_PARQ}" not written ...' )
         return  df
 
     def SearchObqView(self, XY ):
-        view = []
+        dfPNT = pd.DataFrame( { 'NAME': [None], 'X': [XY[0]], 'Y': [XY[1]] } )
+        df = self.SearchObqViews( dfPNT, K=1 )
+        return df[['RigPos', 'RigName', 'ImageStem', 'dist_m']]
+
+    def SearchObqViews(self, dfPNT, K=1, MAX_DIST=None ):
+        ''' batch search of the K nearest views per rig position for all points
+            dfPNT(NAME,X,Y), optionally cut off at MAX_DIST meter. Return long
+            DataFrame one row per (point, rig position, rank) '''
+        XY = dfPNT[['X','Y']].to_numpy( dtype=float )
+        views = []
         for rig, (df,kdTree) in self.KDTrees.items():
-            result = kdTree.query( np.array([XY]), k=1)
-            dist = result[0][0][0]; kpnt = result[1][0][0]; 
-            v = df.iloc[kpnt]
-            view.append( [v.RigPos, v.RigName, v.ImageStem, dist] )
-        df = pd.DataFrame( view, columns=['RigPos', 'RigName', 'ImageStem', 'dist_m'] )
-        return df
+            if len(df)==0: continue            # rig position without foot-print
+            k = min( K, len(df) )
+            dist,idx = kdTree.query( XY, k=k )
+            v = df.iloc[ idx.ravel() ][['RigPos', 'RigName', 'ImageStem']].reset_index( drop=True )
+            v.insert( 0, 'NAME', np.repeat( dfPNT.NAME.to_numpy(), k ) )
+            v['iPNT'] = np.repeat( np.arange( len(XY) ), k )
+            v['rank'] = np.tile( np.arange( 1,k+1 ), len(XY) )
+            v['dist_m'] = dist.ravel()
+            views.append( v )
+        if len(views)==0:
+            raise Warning( '***ERROR*** no rig position has any foot-print ...' )
+        df = pd.concat( views, ignore_index=True )
+        if MAX_DIST is not None:
+            df = df[ df.dist_m<=MAX_DIST ]
+        df = df.sort_values( by='iPNT', kind='stable', ignore_index=True )  # keep rig order
+        return df.drop( labels=['iPNT'], axis=1 )
+
+    def SearchVisibleViews(self, dfPNT, MAX_OBLIQ=None ):
+        ''' views which actually see the points dfPNT(NAME,X,Y,Z) by projecting
+            through all P-matrices, optionally limited by obliquity in degree '''
+        df = self.VisibleImages( dfPNT[['X','Y','Z']].to_numpy( dtype=float ) )
+        if MAX_OBLIQ is not None:
+            df = df[ df.obliq_deg<=MAX_OBLIQ ]
+        df.insert( 0, 'NAME', dfPNT.NAME.to_numpy()[df.iPNT] )
+        return df.drop( labels=['iPNT'], axis=1 ).reset_index( drop=True )
+
+    def CheckTiedRig( self, IMAGE, COL, ROW, HALF_WIN=50 ):
+        ''' images and rig positions tied to IMAGE (ImageStem) by the keypoints
+            within the pixel window around (COL,ROW) e.g. a GCP/LCP marked on IMAGE '''
+        keypnts = self.TPIndex.KeypointsInWindow( IMAGE, COL, ROW, HALF_WIN )
+        df = self.TPIndex.TiedImages( keypnts )
+        df = df.groupby( 'ImageStem' ).size().rename('n_keypnt').reset_index()
+        return pd.merge( df, self.dfImage[['ImageStem','RigPos','RigName']], 
+                         how='left', on='ImageStem' )
 
-    def CopyViewImage( self, dfView ):
+    def CopyViewImage( self, dfView, MODE='copy' ):
         CACHE_VIEW = self.CACHE.joinpath(f'./OBQ_VIEW')
-        CACHE_VIEW.mkdir(parents=True, exist_ok=True)
-        for i,row in dfView.iterrows():
-            src = self.dfImage[ self.dfImage.ImageStem==row.ImageStem ].JPG_Path.iloc[0]
-            dst = Path(CACHE_VIEW).joinpath( src.name )
-            print( f'CopyRigImage: copying  {src} to {dst}...' )
-            shutil.copyfile( src, dst )
+        SRC = self.dfImage.JPG_Path.iloc[ self.ImageIndex( dfView.ImageStem ) ]
+        SRC = SRC[ SRC.notna() ]      # images without JPEG on disk
+        DST = [ CACHE_VIEW.joinpath( src.name ) for src in SRC ]
+        return CopyPhotos( SRC, DST, MODE=MODE )
 
 ##################################################################################
-#   S0795
-LCP_19 = 717551.850,1606212.081,  5.141
-GCP_07 = 717504.492,1606286.262,3.901, 33.619    # N, E , HAE, MSL
-args = None
-view = ObliqueView( args, './CA502_CU_SBR_SmallBlock' )
-df = view.SearchObqView( LCP_19[0:2] ) 
-#df = view.SearchObqView( GCP_07[0:2] ) 
-print( df )
-view.CopyViewImage( df )
-#import pdb ; pdb.set_trace()
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Search oblique views of ground points '\
+            'e.g. GCPs/LCPs from the nearest foot-print centroid of each rig position')
+    parser.add_argument( '-b','--block', action='store', default='./CA502_CU_SBR_SmallBlock',
+            help='block path of Pix4D params and dfPix4dBlock_FootPrint.gpkg' )
+    parser.add_argument( '-p','--points', action='store', 
+            help='CSV of points, first column as name with Easting,Northing columns, '\
+                 'if not specified, LCP_19 is searched' )
+    parser.add_argument( '-k','--nearest', action='store', type=int, default=1,
+            help='number of candidate views per rig position, default 1' )
+    parser.add_argument( '-d','--dist', action='store', type=float,
+            help='cut off candidate views farther than DIST meter' )
+    parser.add_argument( '-v','--visible', action='store_true',
+            help='search views which see the points by projection, points need height' )
+    parser.add_argument( '-c','--copy', action='store_true',
+            help='copy images of the views to CACHE/OBQ_VIEW' )
+    args = parser.parse_args()
+    #   S0795
+    LCP_19 = 717551.850,1606212.081,  5.141
+    GCP_07 = 717504.492,1606286.262,3.901, 33.619    # N, E , HAE, MSL
+    if args.points is None:
+        dfPNT = pd.DataFrame( { 'NAME':['LCP_19'], 'X':[LCP_19[0]], 'Y':[LCP_19[1]], 
+                                'Z':[LCP_19[2]] } )
+    else:
+        dfPNT = pd.read_csv( args.points, encoding='utf-8-sig' )
+        dfPNT.rename( columns={ dfPNT.columns[0]:'NAME', 'Easting':'X', 'Northing':'Y', 
+                        'HAE':'Z', 'Ellipsoidal Height':'Z' }, inplace=True )
+        dfPNT['NAME'] = dfPNT['NAME'].astype(str).str.strip()
+    view = ObliqueView( args, args.block )
+    if args.visible:
+        df = view.SearchVisibleViews( dfPNT )
+    else:
+        df = view.SearchObqViews( dfPNT, K=args.nearest, MAX_DIST=args.dist ) 
+    print( df )
+    if args.copy: view.CopyViewImage( df.drop_duplicates('ImageStem') )
+    #import pdb ; pdb.set_trace()
@@ -0,0 +1,74 @@
+#
+#
+# RigCheck_Lib.py : validate rig integrity of an oblique block with grouped
+#                   aggregations in one pass i.e. images per rig, missing or
+#                   duplicate rig positions, spread of datetime_digitized and
+#                   monotonic rig numbers, then adjust the rig timestamps.
+#                   Shared by CheckDT_Sync.py and CopyRegion.py
+# Author : P.Santitamnont (Phisan.Chula@gmail.com)
+#
+#
+import numpy as np
+import pandas as pd
+
+SPREAD_BIN = [ -np.inf, 0, 1, 2, 5, 10, 60, np.inf ]   # second
+
+##########################################################################
+def ValidateRig( df, RIG_POSITION, RIG='RigName', POS='RigPos', DT=None, INCR_SEC=1 ):
+    ''' one row per image df[RIG,POS,(DT)], return dict of report DataFrames
+          'rig'         : per rig counts, missing/duplicate positions, spread
+          'missing'     : rigs missing any of RIG_POSITION
+          'duplicate'   : rigs with a position more than once
+          'spread_hist' : histogram of datetime spread within rigs (if DT)
+          'adjusted'    : images of complete but unsynced rigs with 'dtAdj',
+                          RUN_DT+INCR_SEC per rig or median if INCR_SEC is None '''
+    NPOS = len(RIG_POSITION)
+    cnt = pd.crosstab( df[RIG], df[POS] ).reindex( columns=RIG_POSITION, fill_value=0 )
+    dfRig = pd.DataFrame( { 'n': cnt.sum( axis=1 ) } )
+    dfRig['n'] += df[~df[POS].isin( RIG_POSITION )].groupby( RIG ).size().\
+                        reindex( dfRig.index, fill_value=0 )
+    SEP = pd.Index( [ f'{p},' for p in RIG_POSITION ] )
+    dfRig['missing'] = cnt.eq(0).dot( SEP ).str.rstrip(',')
+    dfRig['duplicate'] = cnt.gt(1).dot( SEP ).str.rstrip(',')
+    dfRig['complete'] = (dfRig.n==NPOS) & (dfRig.missing=='') & (dfRig.duplicate=='')
+    report = { 'rig': dfRig }
+    report['missing'] = dfRig[ dfRig.missing!='' ]
+    report['duplicate'] = dfRig[ dfRig.duplicate!='' ]
+    if DT is None: return report
+    #############################################
+    g = df.groupby( RIG )[DT]
+    dfRig['dt_min'] = g.min() ; dfRig['dt_median'] = g.median()
+    dfRig['dt_nunique'] = g.nunique()
+    dfRig['spread_sec'] = ( g.max()-g.min() ).dt.total_seconds()
+    report['spread_hist'] = pd.cut( dfRig.spread_sec, SPREAD_BIN ).value_counts( sort=False )
+    # capture time must increase with rig number, a rig is flagged when it
+    # was taken before any rig of lower number
+    RIGNUM = pd.to_numeric( dfRig.index.to_series(), errors='coerce' )
+    dt_min = dfRig.dt_min.iloc[ np.argsort( RIGNUM.to_numpy(), kind='stable' ) ]
+    dfRig['monotonic'] = ( dt_min>=dt_min.cummax() ).reindex( dfRig.index )
+    #############################################
+    ADJ = dfRig[ dfRig.complete & (dfRig.dt_nunique!=1) ].copy()
+    if not ADJ.index.to_series().pipe( pd.to_numeric, errors='coerce' ).is_monotonic_increasing:
+        raise Warning( '***ERROR*** rig numbers to be adjusted are not monotonic ...' )
+    if INCR_SEC is None:
+        ADJ['dtAdj'] = ADJ.dt_median
+    else:
+        RUN_DT = df[DT].min()
+        ADJ['dtAdj'] = RUN_DT + pd.to_timedelta( INCR_SEC*np.arange( 1,len(ADJ)+1 ), unit='s' )
+    dfAdj = df[ df[RIG].isin( ADJ.index ) ].copy()
+    dfAdj['dtAdj'] = dfAdj[RIG].map( ADJ.dtAdj )
+    report['adjusted'] = dfAdj.sort_values( by=RIG, kind='stable' )
+    return report
+
+def PrintReport( report ):
+    dfRig = report['rig']
+    NONMONO = f'  non-monotonic = {(~dfRig.monotonic).sum():,}' \
+                    if 'monotonic' in dfRig else ''
+    print( f'Total rig = {len(dfRig):,}  complete = {dfRig.complete.sum():,}{NONMONO}' )
+    for key in ( 'missing', 'duplicate' ):
+        if len( report[key] ):
+            print( f'***ERROR*** {len(report[key]):,} rigs with {key} positions ...' )
+            print( report[key][['n','missing','duplicate']] )
+    if 'spread_hist' in report:
+        print( 'Histogram of datetime spread within rig (second) :' )
+        print( report['spread_hist'].to_string() )
@@ -10,13 +10,45 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point,LineString
+import shapely
 import pymap3d as pm
 import argparse
 import pathlib
 
 FLAG = { 0: 'no positioning', 16: 'single-point mode', 34: 'floating solution', 
         50: 'fixed solution' }
+TRJ_INTERP = [ 'Latitude','Longitude', 'H-Ell','SDHoriz','SDHeight' ]
+
+def InterpolateEvents( dfTRJ, TIME, COLS=TRJ_INTERP, MAX_GAP=None ):
+    ''' interpolate trajectory COLS linearly at event TIME (GPSTimeSec), the
+        bracketing epochs are found by binary search and Q is the worse of
+        both. Column 'INTERP' flags each event as "interp", "exact" (on an
+        epoch), "gap" (epochs more than MAX_GAP sec apart, default twice the
+        median interval) or "outside" the trajectory (COLS and Q are NaN).
+        Duplicated epochs are dropped keeping the first '''
+    dfTRJ = dfTRJ.sort_values( 'GPSTimeSec', kind='stable' )
+    dfTRJ = dfTRJ.drop_duplicates( 'GPSTimeSec', keep='first' )  # dt=0 otherwise
+    if len(dfTRJ)<2:
+        raise Warning( f'***ERROR*** trajectory needs at least 2 epochs, got {len(dfTRJ)} ...' )
+    T = dfTRJ.GPSTimeSec.to_numpy( float )
+    if MAX_GAP is None: MAX_GAP = 2*np.median( np.diff( T ) )
+    TIME = np.asarray( TIME, dtype=float )
+    i0 = np.clip( np.searchsorted( T, TIME, side='right' )-1, 0, len(T)-2 )
+    i1 = i0+1
+    dt = T[i1]-T[i0]
+    w = ( TIME-T[i0] )/dt
+    dfEVT = pd.DataFrame( { 'GPSTimeSec': TIME } )
+    for col in COLS:
+        V = dfTRJ[col].to_numpy( float )
+        dfEVT[col] = V[i0] + w*( V[i1]-V[i0] )
+    Q = dfTRJ.Q.to_numpy( float )
+    EXACT0, EXACT1 = TIME==T[i0], TIME==T[i1]
+    OUTSIDE = (TIME<T[0]) | (TIME>T[-1])
+    dfEVT['Q'] = np.select( [ EXACT0, EXACT1 ], [ Q[i0], Q[i1] ], np.maximum( Q[i0], Q[i1] ) )
+    dfEVT.loc[ OUTSIDE, COLS+['Q'] ] = np.nan
+    dfEVT['INTERP'] = np.select( [ OUTSIDE, EXACT0|EXACT1, dt>MAX_GAP ], 
+                                 [ 'outside', 'exact', 'gap' ], 'interp' )
+    return dfEVT
 
 class DronePPK:
     def __init__( self , ARGS ):
@@ -32,26 +64,25 @@ class DronePPK:
         dfTRJ['EVENT'] = 'TRAJECTORY'
         gdfTRJ = gpd.GeoDataFrame( dfTRJ, crs='EPSG:4326', 
                 geometry=gpd.points_from_xy( dfTRJ.Longitude, dfTRJ.Latitude) )
-        trj_lin = list()
-        for i in range( len(gdfTRJ)-1 ):
-            p,q = gdfTRJ.iloc[i], gdfTRJ.iloc[i+1]
-            trj_lin.append( LineString( [ p.geometry, q.geometry ] ) )
+        LNG_LAT = dfTRJ[['Longitude','Latitude']].to_numpy()
+        trj_lin = shapely.linestrings( np.stack( [ LNG_LAT[:-1], LNG_LAT[1:] ], axis=1 ) )
         gdfTRJ_LIN = gpd.GeoDataFrame( crs='EPSG:4326', geometry=trj_lin ) 
-        #import pdb ; pdb.set_trace()
-        dfTRJ = pd.concat( [dfTRJ, dfMRK], axis=0, ignore_index=True)
-        dfTRJ.set_index( 'GPSTimeSec', drop=False, inplace=True, verify_integrity=True )
-        dfTRJ.sort_index( axis=0, inplace=True )
-        dfTRJ = dfTRJ[[ 'Latitude','Longitude', 'H-Ell','SDHoriz','SDHeight' , 
-                         'Q','EVENT','N_CORR','E_CORR','H_CORR' ]]
-        dfTRJ.interpolate(method='slinear', inplace=True)
-        dfPho = dfTRJ[ ~dfTRJ.EVENT.isin( ['TRAJECTORY'] ) ].copy()
+        dfPho = InterpolateEvents( dfTRJ, dfMRK.GPSTimeSec )
+        for col in [ 'EVENT','N_CORR','E_CORR','H_CORR' ]:
+            dfPho[col] = dfMRK[col].to_numpy()
+        dfPho = dfPho.sort_values( 'GPSTimeSec', kind='stable' ).set_index( 'GPSTimeSec' )
+        dfPho = dfPho[[ 'Latitude','Longitude', 'H-Ell','SDHoriz','SDHeight' , 
+                         'Q','EVENT','N_CORR','E_CORR','H_CORR','INTERP' ]]
+        FLAGGED = dfPho[ dfPho.INTERP.isin( ['gap','outside'] ) ]
+        if len(FLAGGED):
+            print( f'***WARNING*** {len(FLAGGED)} events in trajectory gap or outside ...' )
+            print( FLAGGED[['EVENT','INTERP']] )
         self.gdfMRK = gpd.GeoDataFrame( dfPho,  crs='EPSG:4326',
                  geometry=gpd.points_from_xy( dfPho.Longitude, dfPho.Latitude ) ).copy()
-        def MakeOffset( row ):
-            lat,lng,hae = pm.enu2geodetic( row.E_CORR, row.N_CORR, -row.H_CORR,
-                             row.Latitude, row.Longitude, row['H-Ell'] , ell=None, deg=True)
-            return [ lat,lng,hae ]
-        dfPho[['Lat_EOP', 'Lng_EOP', 'h_EOP']] = dfPho.apply( MakeOffset,axis=1,result_type='expand')
+        lat,lng,hae = pm.enu2geodetic( dfPho.E_CORR.to_numpy(), dfPho.N_CORR.to_numpy(), 
+                         -dfPho.H_CORR.to_numpy(), dfPho.Latitude.to_numpy(), 
+                         dfPho.Longitude.to_numpy(), dfPho['H-Ell'].to_numpy(), ell=None, deg=True)
+        dfPho['Lat_EOP'], dfPho['Lng_EOP'], dfPho['h_EOP'] = lat, lng, hae
         self.gdfEOP = gpd.GeoDataFrame( dfPho, crs='EPSG:4326', 
                        geometry=gpd.points_from_xy( dfPho.Lng_EOP, dfPho.Lat_EOP ) ).copy()
         self.gdfTRJ, self.gdfTRJ_LIN = gdfTRJ, gdfTRJ_LIN
@@ -60,14 +91,10 @@ class DronePPK:
         HDR = ['EVENT', 'GPSTimeSec', 'GPS_Week', 'N_CORR', 'E_CORR', 'H_CORR', 
                  'RT_Lat', 'RT_Lng', 'RT_h', 'Std_N', 'Std_E', 'Std_h', 'Flag' ]
         df = pd.read_csv( self.ARGS.MRKFILE, header=None, names=HDR, delim_whitespace=True )
-        def SplitVal( arg ):
-            val,param = arg.split( ',')
-            if param in ['N','E','V']:
-                return float( val )/1000.  # mm to meter 
-            else:
-                return float( val ) 
         for col in ['N_CORR','E_CORR','H_CORR','RT_Lat','RT_Lng','RT_h','Std_N','Std_E' ]:
-            df[col] = df[col].apply( SplitVal )
+            val,_,param = df[col].astype(str).str.partition( ',' ).T.to_numpy()
+            val = val.astype( float )
+            df[col] = np.where( np.isin( param, ['N','E','V'] ), val/1000., val ) # mm to meter
         #import pdb ; pdb.set_trace()
         return df
 